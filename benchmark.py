@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Performance benchmarks for the package, for comparing one version (or
+# machine, or Python) against another:
+#
+#     $ python benchmark.py -o before.json
+#     ... change things ...
+#     $ python benchmark.py -o after.json --compare before.json
+#
+# Everything runs offline on synthetic inputs drawn from a seeded random
+# generator, so two runs with the same arguments look up exactly the same
+# points: one set spread uniformly over lon/lat, and one weighted by
+# population, drawn from the subunits' boxes in proportion to their
+# pop_est. Cold import time and memory are measured in fresh interpreters
+# so that nothing this script has loaded skews them.
+#
+# Only the oldest API is required, so the script also measures releases
+# from before the lookups and modules it times were added; whatever a
+# release lacks is reported as null, and left out of comparisons.
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import country_bounding_boxes
+from country_bounding_boxes import (
+    all_country_subunits,
+    all_country_subunits_grouped_by_iso_3_code,
+    country_subunits_by_iso_code,
+    country_subunits_containing_point,
+)
+
+# Lookups added in later releases, or None in those without them.
+country_subunits_intersecting_bbox = getattr(
+    country_bounding_boxes, 'country_subunits_intersecting_bbox', None)
+smallest_country_subunit_containing_point = getattr(
+    country_bounding_boxes, 'smallest_country_subunit_containing_point',
+    None)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Percentiles reported for per-call latencies.
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def uniform_points(rng, n):
+    return [(rng.uniform(-180.0, 180.0), rng.uniform(-90.0, 90.0))
+            for _ in range(n)]
+
+
+def population_points(rng, n):
+    # Pick subunits in proportion to their population, then a point
+    # uniformly inside the chosen subunit's box.
+    subunits = [c for c in all_country_subunits() if c.pop_est > 0]
+    total = 0.0
+    cumulative = []
+    for c in subunits:
+        total += c.pop_est
+        cumulative.append(total)
+    res = []
+    for _ in range(n):
+        x = rng.uniform(0.0, total)
+        (lo, hi) = (0, len(cumulative) - 1)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumulative[mid] < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        (lon1, lat1, lon2, lat2) = subunits[lo].bbox
+        res.append((rng.uniform(lon1, lon2), rng.uniform(lat1, lat2)))
+    return res
+
+
+def iso_codes(rng, n):
+    # Every alpha2 and alpha3 code of the subunits and every alpha3 code
+    # they are grouped under, in upper and lower case, plus a tenth as
+    # many codes that match nothing.
+    codes = set(code for (code, _) in
+                all_country_subunits_grouped_by_iso_3_code() if code)
+    for c in all_country_subunits():
+        codes.update(code for code in (c.iso_a2, c.iso_a3)
+                     if len(code) in (2, 3) and code.isalpha())
+    codes = sorted(codes)
+    codes = codes + [c.lower() for c in codes]
+    return [rng.choice(codes) if rng.random() < 0.9 else 'ZZ'
+            for _ in range(n)]
+
+
+def boxes(rng, n):
+    # Windows of 0.1 to 10 degrees a side, about a uniform centre.
+    res = []
+    for _ in range(n):
+        (w, h) = (rng.uniform(0.1, 10.0), rng.uniform(0.1, 10.0))
+        lon = rng.uniform(-180.0, 180.0 - w)
+        lat = rng.uniform(-90.0, 90.0 - h)
+        res.append((lon, lat, lon + w, lat + h))
+    return res
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(int(round(p / 100.0 * (len(sorted_values) - 1))),
+            len(sorted_values) - 1)
+    return sorted_values[k]
+
+
+def summarize(latencies, total):
+    # Throughput from the total time of the loop; latencies (in
+    # microseconds) from timing each call.
+    latencies = sorted(latencies)
+    res = {
+        'calls': len(latencies),
+        'per_second': len(latencies) / total if total else None,
+        'mean_us': 1e6 * sum(latencies) / len(latencies),
+        'max_us': 1e6 * latencies[-1],
+    }
+    for p in PERCENTILES:
+        res['p%s_us' % ('%g' % p).replace('.', '_')] = \
+            1e6 * percentile(latencies, p)
+    return res
+
+
+def bench_calls(func, args, repeat):
+    # Time func(*a) for every a in args, repeat times, keeping the
+    # fastest loop's total and every call's latency from that loop.
+    best = None
+    for _ in range(repeat):
+        latencies = []
+        append = latencies.append
+        start = clock()
+        for a in args:
+            t = clock()
+            func(*a)
+            append(clock() - t)
+        total = clock() - start
+        if best is None or total < best[1]:
+            best = (latencies, total)
+    return summarize(*best)
+
+
+def bench_batch(func, repeat):
+    # The fastest of repeat runs of func(), in seconds.
+    best = None
+    for _ in range(repeat):
+        start = clock()
+        func()
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_python(code):
+    # Run code in a fresh interpreter that can import the package from
+    # this tree, and return what it prints, parsed as JSON.
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [HERE] + [p for p in [env.get('PYTHONPATH')] if p])
+    out = subprocess.check_output([sys.executable, '-c', code], env=env,
+                                  cwd=HERE)
+    return json.loads(out.decode('utf-8'))
+
+
+_IMPORT = '''
+import json, time
+clock = getattr(time, 'perf_counter', time.time)
+t = clock()
+import country_bounding_boxes as cbb
+imported = clock()
+list(cbb.country_subunits_containing_point(0.0, 0.0))
+first_point = clock()
+list(cbb.country_subunits_by_iso_code('FR'))
+first_code = clock()
+print(json.dumps([imported - t, first_point - imported,
+                  first_code - first_point]))
+'''
+
+
+def bench_import(runs):
+    samples = [run_python(_IMPORT) for _ in range(runs)]
+    res = {}
+    for (k, name) in enumerate(['import_ms', 'first_point_ms',
+                                'first_iso_code_ms']):
+        values = sorted(1e3 * s[k] for s in samples)
+        res[name] = {'median': percentile(values, 50), 'min': values[0],
+                     'max': values[-1]}
+    return res
+
+
+# The resident set size of the interpreter after each step, from
+# /proc/self/status where there is one (current and peak), else the peak
+# from getrusage.
+_MEMORY = '''
+import json, os, resource, sys
+
+def rss():
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return [int(status[k].split()[0]) for k in ('VmRSS', 'VmHWM')]
+    except (IOError, OSError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak //= 1024
+        return [None, peak]
+
+res = {'interpreter': rss()}
+import country_bounding_boxes as cbb
+res['imported'] = rss()
+list(cbb.country_subunits_containing_point(0.0, 0.0))
+if hasattr(cbb, 'country_subunits_intersecting_bbox'):
+    list(cbb.country_subunits_intersecting_bbox(0.0, 0.0, 1.0, 1.0))
+list(cbb.country_subunits_by_iso_code('FR'))
+res['indexes_loaded'] = rss()
+for c in cbb.all_country_subunits():
+    tuple(c)
+res['all_fields_read'] = rss()
+print(json.dumps(res))
+'''
+
+
+def bench_memory(shared=False):
+    if sys.platform.startswith('win'):
+        return None
+    code = _MEMORY
+    if shared:
+        code = "import os; os.environ['COUNTRY_BOUNDING_BOXES_SHARED'] = " \
+               "'1'\n" + code
+    res = run_python(code)
+    return dict((step, {'rss_kb': v[0], 'peak_rss_kb': v[1]})
+                for (step, v) in res.items())
+
+
+def _has_smallest_first():
+    try:
+        country_subunits_containing_point(0.0, 0.0, smallest_first=True)
+    except TypeError:
+        return False
+    return True
+
+
+def bench_point_lookups(points, repeat):
+    args = [(lon, lat) for (lon, lat) in points]
+    res = {
+        'containing_point': bench_calls(
+            lambda lon, lat: list(country_subunits_containing_point(
+                lon, lat)), args, repeat),
+        'containing_point_smallest_first': None,
+        'smallest_containing_point': None,
+    }
+    if _has_smallest_first():
+        res['containing_point_smallest_first'] = bench_calls(
+            lambda lon, lat: list(country_subunits_containing_point(
+                lon, lat, smallest_first=True)), args, repeat)
+    if smallest_country_subunit_containing_point is not None:
+        res['smallest_containing_point'] = bench_calls(
+            smallest_country_subunit_containing_point, args, repeat)
+    return res
+
+
+def bench_point_cache(points, repeat):
+    try:
+        from country_bounding_boxes.cache import PointCache
+    except ImportError:
+        return None
+    cache = PointCache()
+    # Each point twice, so that about half the lookups can be hits.
+    args = points + points
+    res = bench_calls(lambda lon, lat: list(cache(lon, lat)), args, repeat)
+    res['hit_rate'] = float(cache.hits) / max(cache.hits + cache.misses, 1)
+    return res
+
+
+def bench_batches(points, repeat, processes):
+    res = {}
+    try:
+        import numpy
+        from country_bounding_boxes import batch
+    except ImportError:
+        res['numpy'] = None
+    else:
+        lons = numpy.array([p[0] for p in points])
+        lats = numpy.array([p[1] for p in points])
+        seconds = bench_batch(
+            lambda: batch.country_subunits_containing_points(lons, lats),
+            repeat)
+        res['numpy'] = {'seconds': seconds,
+                        'points_per_second': len(points) / seconds}
+
+    try:
+        from country_bounding_boxes import parallel
+    except ImportError:
+        res['parallel'] = None
+    else:
+        seconds = bench_batch(
+            lambda: list(parallel.country_subunits_containing_points(
+                points, processes=processes)), repeat)
+        res['parallel'] = {'processes': processes, 'seconds': seconds,
+                           'points_per_second': len(points) / seconds}
+    return res
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                          cwd=HERE, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    point_sets = [('uniform', uniform_points(rng, args.points)),
+                  ('population', population_points(rng, args.points))]
+    codes = [(c, ) for c in iso_codes(rng, args.points)]
+    windows = boxes(rng, max(args.points // 10, 1))
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': _cpu_count(),
+            'revision': git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'seed': args.seed,
+            'points': args.points,
+            'repeat': args.repeat,
+        },
+        'import': bench_import(args.import_runs),
+        'memory': bench_memory(),
+        'memory_shared': bench_memory(shared=True),
+        'iso_code': bench_calls(
+            lambda code: list(country_subunits_by_iso_code(code)),
+            codes, args.repeat),
+        'intersecting_bbox': None,
+    }
+    if country_subunits_intersecting_bbox is not None:
+        results['intersecting_bbox'] = bench_calls(
+            lambda *b: list(country_subunits_intersecting_bbox(*b)),
+            windows, args.repeat)
+    for (name, points) in point_sets:
+        res = bench_point_lookups(points, args.repeat)
+        res['point_cache'] = bench_point_cache(points, args.repeat)
+        if not args.no_batch:
+            res['batch'] = bench_batches(points, args.repeat, args.jobs)
+        results['points_' + name] = res
+    return results
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def _flatten(results, prefix=''):
+    # The numbers in nested results, by dotted path.
+    res = {}
+    for (k, v) in results.items():
+        if isinstance(v, dict):
+            res.update(_flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            res[prefix + k] = v
+    return res
+
+
+def compare(old, new, out):
+    """
+    Write, for every measurement in both result sets, the old and new
+    values and their ratio (new / old).
+    """
+    for k in ('seed', 'points', 'repeat'):
+        if old['meta'].get(k) != new['meta'].get(k):
+            out.write("warning: runs differ in %s (%r, now %r)\n"
+                      % (k, old['meta'].get(k), new['meta'].get(k)))
+    (old, new) = (_flatten(old), _flatten(new))
+    for k in sorted(set(old) & set(new)):
+        if k.startswith('meta.') or k.endswith(('.calls', '.processes')) \
+           or not old[k]:
+            continue
+        out.write('%-60s %14.3f %14.3f %8.2fx\n'
+                  % (k, old[k], new[k], new[k] / float(old[k])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark imports, lookups and memory use.")
+    parser.add_argument('-o', '--output',
+                        help="write the results to this JSON file "
+                             "(default: standard output)")
+    parser.add_argument('--compare', metavar='JSON',
+                        help="compare the results with an earlier run")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed for the inputs (default: 0)")
+    parser.add_argument('-n', '--points', type=int, default=20000,
+                        help="points (and ISO codes) per input set "
+                             "(default: 20000)")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="timing runs, keeping the fastest "
+                             "(default: 3)")
+    parser.add_argument('--import-runs', type=int, default=5,
+                        help="fresh interpreters to time imports in "
+                             "(default: 5)")
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help="worker processes for the parallel batch "
+                             "benchmark (default: 2)")
+    parser.add_argument('--no-batch', action='store_true',
+                        help="skip the batch APIs")
+    args = parser.parse_args(argv)
+    for name in ('points', 'repeat', 'import_runs', 'jobs'):
+        if getattr(args, name) < 1:
+            parser.error("--%s must be positive" % name.replace('_', '-'))
+
+    results = run(args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results, sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
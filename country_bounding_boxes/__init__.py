@@ -2,16 +2,43 @@
 # -*- coding: utf-8 -*-
 #
 
-import iso3166
 import json
+import os
 import sys
-from country_bounding_boxes.generated import countries
+from country_bounding_boxes import _data, _polygons
+from country_bounding_boxes.index import (
+    QuadkeyIndex,
+    STRTree,
+    box_area_km2,
+    box_distance_degrees,
+    box_distance_km,
+)
+
+# Raised by precise lookups when the outlines they need are not installed.
+MissingOutlines = _polygons.MissingOutlines
 
 if sys.version_info > (3, ):
     string_types = str
 else:
     string_types = basestring
 
+# Country records are loaded from the compact data file written by
+# parse.py. Each is a lightweight record holding its bbox and row number,
+# with the other fields read from the shared table on access; Country is
+# the equivalent full namedtuple type (which records pickle as).
+#
+# The file is memory-mapped and read in place. With
+# COUNTRY_BOUNDING_BOXES_SHARED set to 1 (or true, yes or on) in the
+# environment, the values decoded from it are not kept either, so that the
+# many worker processes of a server hold next to nothing of the dataset
+# beyond the one copy of the file they all share. Any other value, such
+# as 0 or false, leaves it off.
+_shared = os.environ.get('COUNTRY_BOUNDING_BOXES_SHARED', '')
+countries = _data.CountryList(_data.load(
+    shared=_shared.strip().lower() in ('1', 'true', 'yes', 'on')))
+Country = countries.table.Country
+Country.__module__ = __name__
+
 # The naturalearth dataset we're using contains "subunits" of a variety of
 # forms; Some are "full sized" countries, some are historically or
 # politically significant divisions within the country (eg. Scotland and
@@ -19,104 +46,315 @@ else:
 # (eg. Alaska) and some are islands, dependencies, overseas departments,
 # or similar special cases. As a result, we return a _set_ of countries
 # for each iso code.
-_iso_2_cache = {}
-_iso_3_cache = {}
+#
+# Which ISO codes each subunit belongs under is worked out by parse.py and
+# shipped in the data file, already free of duplicates; the caches map
+# each alpha2 and alpha3 code to a tuple of its subunits.
+#
+# The tuple for a code is made the first time it is asked for, so the
+# first lookup pays for that code alone. Like the other lazily-built
+# structures below, each is built into a local and published with a single
+# assignment, so a concurrent caller sees either nothing (and builds its
+# own, identical tuple) or the complete tuple. Codes that are not in the
+# index are not stored.
+_iso_caches = None
+
+# Spatial indexes over the subunit bounding boxes, both precomputed by
+# parse.py and set up on first use. Points go through the quadkey table,
+# which answers most of them in a single probe; rectangles go through the
+# R-tree.
+_quadkeys = None
+_rtree = None
+
+# Columnar view of the dataset, built on first use.
+_columns = None
+
+# Simplified subunit outlines for precise point lookups, by level of
+# detail, each loaded on first use.
+_outlines = {}
+
+# Each subunit's rank when they are ordered by the spherical area of their
+# bounding boxes, smallest first (ties in dataset order): a point's most
+# specific subunit is the one of lowest rank. Worked out on first use.
+_ranks = None
+
+
+def _iso_cache_pair():
+    global _iso_caches
+    caches = _iso_caches
+    if caches is None:
+        caches = _iso_caches = ({}, {})
+    return caches
+
+
+def _iso_subunits(code):
+    # The subunits filed under an upper-case alpha2 or alpha3 code.
+    (iso_2_cache, iso_3_cache) = _iso_cache_pair()
+    if len(code) == 2:
+        (cache, index) = (iso_2_cache, countries.table.iso_2_index)
+    elif len(code) == 3:
+        (cache, index) = (iso_3_cache, countries.table.iso_3_index)
+    else:
+        return ()
+    res = cache.get(code)
+    if res is None:
+        rows = index.get(code)
+        if rows is None:
+            return ()
+        res = cache[code] = tuple(countries[i] for i in rows)
+    return res
 
 
-# The legitimate ISO 3166 alpha2 and alpha3 names, which appear in a variety
-# of contexts in the naturalearth dataset depending on the subunit being
-# described.
-_iso_2_names = set()
-_iso_3_names = set()
+def _ensure_caches_populated():
+    # Fill the caches for every code, as the server does before it starts.
+    (iso_2_cache, iso_3_cache) = _iso_cache_pair()
+    for (cache, index) in [(iso_2_cache, countries.table.iso_2_index),
+                           (iso_3_cache, countries.table.iso_3_index)]:
+        for (code, rows) in index.items():
+            if code not in cache:
+                cache[code] = tuple(countries[i] for i in rows)
+    return (iso_2_cache, iso_3_cache)
+
+
+def _quadkey_index():
+    global _quadkeys
+    if _quadkeys is None:
+        if countries.table.quadkeys is not None:
+            _quadkeys = QuadkeyIndex(countries.bboxes(),
+                                     *countries.table.quadkeys)
+        else:
+            _quadkeys = QuadkeyIndex.build(countries.bboxes())
+    return _quadkeys
+
+
+def _rtree_index():
+    global _rtree
+    if _rtree is None:
+        if countries.table.rtree is not None:
+            # The tree is small (about one node per eight subunits) and
+            # read on every step of a search, where a tuple is quicker to
+            # index than a view of the file.
+            (capacity, leaf_start, boxes, links, items) = \
+                countries.table.rtree
+            _rtree = STRTree.from_arrays(countries.bboxes(), capacity,
+                                         leaf_start, tuple(boxes),
+                                         tuple(links), tuple(items))
+        else:
+            _rtree = STRTree(countries.bboxes())
+    return _rtree
+
+
+def _specificity_ranks():
+    global _ranks
+    if _ranks is None:
+        areas = [box_area_km2(b) for b in countries.bboxes()]
+        ranks = [0] * len(areas)
+        for (rank, i) in enumerate(sorted(range(len(areas)),
+                                          key=areas.__getitem__)):
+            ranks[i] = rank
+        _ranks = ranks
+    return _ranks
+
+
+def _polygon_outlines(level):
+    outlines = _outlines.get(level)
+    if outlines is None:
+        if level not in _polygons.LEVELS:
+            raise ValueError("unknown resolution %r" % (level, ))
+        outlines = _polygons.load_level(level)
+        if outlines.rows != len(countries):
+            raise ValueError("polygon file does not match the country data")
+        _outlines[level] = outlines
+    return outlines
+
+
+def _preload(precise=False, resolution=_polygons.DEFAULT_LEVEL):
+    # Build everything point lookups need up front: for servers, so that
+    # no request pays for it, and before forking worker processes, so that
+    # they all inherit it.
+    _quadkey_index()
+    _specificity_ranks()
+    if precise:
+        _polygon_outlines(resolution)
+
+
+def _point_query(lon, lat, precise, resolution):
+    # Positions of the subunits containing the point, in dataset order.
+    #
+    # To handle international date line spanning
+    # bboxes -- namely Fiji -- we treat any country that's
+    #
+    # Fiji spans the international date line
+    # (-180.0, -21.705859375, 180.0, -12.476953125),
+    #
+    # England does not
+    # (-5.65625, 50.0213867188, 1.74658203125, 55.8079589844),
+    #
+    # This poses a bit of difficulty, because they both appear
+    # "numerically" the same way, as a bounding box going from low
+    # longitude to high longitude. The problem is that passing the
+    # international date line means you should interpret the box
+    # as running from high to low
+    #
+    # The quadkey table either knows the answer for the point's cell
+    # outright or narrows down the boxes to test; the test itself is the
+    # same inclusive comparison as always. Precise lookups then only
+    # ray-cast against the outlines of the boxes that matched.
+    if precise and resolution not in _polygons.LEVELS:
+        raise ValueError("unknown resolution %r" % (resolution, ))
+    hits = _quadkey_index().query_point(lon, lat)
+    if precise and hits:
+        outlines = _polygon_outlines(resolution)
+        hits = [i for i in hits if outlines.contains(i, lon, lat)]
+    return hits
+
+
+def _points_query(points, precise, resolution):
+    # _point_query for each (lon, lat) of points, probing the quadkey
+    # table for the whole batch in one pass.
+    if precise and resolution not in _polygons.LEVELS:
+        raise ValueError("unknown resolution %r" % (resolution, ))
+    res = _quadkey_index().query_points(points)
+    if precise:
+        outlines = None
+        for (k, hits) in enumerate(res):
+            if hits:
+                if outlines is None:
+                    outlines = _polygon_outlines(resolution)
+                (lon, lat) = points[k]
+                res[k] = [i for i in hits if outlines.contains(i, lon, lat)]
+    return res
+
+
+def country_subunits_containing_point(lon, lat, precise=False,
+                                      resolution=_polygons.DEFAULT_LEVEL,
+                                      smallest_first=False):
+    """
+    Iterate over the country subunits that contain the provided point.
+    Each subunit will have a .bbox field indicating its (lon1, lat1, lon2,
+    lat2) bounding box.
 
+    By default a subunit contains the point if its bounding box does. With
+    precise=True, the point must also be inside the subunit's (simplified)
+    outline, at the given resolution: '110m' (coarsest and quickest),
+    '50m' or '10m' (most accurate, and largest in memory). That needs the
+    polygons_<resolution>.dat file built by parse.py. Subunits without an
+    outline are taken to fill their boxes.
 
-def _is_iso_3_name(n):
-    if len(_iso_3_names) == 0:
-        for c in iso3166.countries:
-            _iso_3_names.add(c.alpha3)
-    return n in _iso_3_names
+    Subunits come in dataset order, or with smallest_first=True, most
+    specific first: ordered by the area of their bounding boxes on the
+    globe, smallest first.
+    """
+    hits = _point_query(lon, lat, precise, resolution)
+    if smallest_first:
+        hits.sort(key=_specificity_ranks().__getitem__)
+    return iter([countries[i] for i in hits])
 
 
-def _is_iso_2_name(n):
-    if len(_iso_2_names) == 0:
-        for c in iso3166.countries:
-            _iso_2_names.add(c.alpha2)
-    return n in _iso_2_names
+def smallest_country_subunit_containing_point(
+        lon, lat, precise=False, resolution=_polygons.DEFAULT_LEVEL):
+    """
+    Return the most specific country subunit containing the provided point
+    (the one with the smallest bounding box, by area on the globe), or None
+    if there is none. precise and resolution are as for
+    country_subunits_containing_point.
+    """
+    hits = _point_query(lon, lat, precise, resolution)
+    if not hits:
+        return None
+    return countries[min(hits, key=_specificity_ranks().__getitem__)]
 
 
-# Depending on the type of the (sub)unit, the ISO alpha3 name this
-# "country" is connected to might be denoted in a variety of fields. Search
-# them all in a hopefully-useful order of precedence and take the first
-# that looks legit.
-def _best_guess_iso_3(c):
-    for n in [c.iso_a3, c.adm0_a3, c.adm0_a3_is,
-              c.adm0_a3_us, c.gu_a3, c.su_a3, c.sov_a3]:
-        if n != "-99" and _is_iso_3_name(n):
-            return n
-    return None
+def _window_parts(lon1, lat1, lon2, lat2):
+    # A window whose western edge lies east of its eastern edge crosses
+    # the international date line; no subunit box does (those that would
+    # were split in two by parse.py), so query each side of the line as a
+    # separate box.
+    if lon1 > lon2:
+        return [(lon1, lat1, 180.0, lat2), (-180.0, lat1, lon2, lat2)]
+    return [(lon1, lat1, lon2, lat2)]
 
 
-# ISO alpha3 names are much more prevalent in the NE dataset; look up the
-# corresponding alpha2 name from iso3166 and cross-check against any alpha2
-# name we have in the NE record.
-def _best_guess_iso_2(c):
-    iso3 = _best_guess_iso_3(c)
-    if iso3 is None:
-        return None
-    isoc = iso3166.countries.get(iso3)
-    if isoc is None:
-        return None
-    iso2 = isoc.alpha2
-    if c.iso_a2 != "-99" and _is_iso_2_name(c.iso_a2):
-        assert c.iso_a2 == iso2
-    return iso2
+def _window_query(lon1, lat1, lon2, lat2, within):
+    tree = _rtree_index()
+    bboxes = tree.bboxes
+    hits = set()
+    for (x1, y1, x2, y2) in _window_parts(lon1, lat1, lon2, lat2):
+        for i in tree.query_bbox((x1, y1, x2, y2)):
+            b = bboxes[i]
+            if not within or (x1 <= b[0] and b[2] <= x2 and
+                              y1 <= b[1] and b[3] <= y2):
+                hits.add(i)
+    return iter([countries[i] for i in sorted(hits)])
 
 
-def _ensure_caches_populated():
-    global _iso_2_cache
-    global _iso_3_cache
-    if not _iso_2_cache:
-        for c in countries:
-            iso2 = _best_guess_iso_2(c)
-            iso3 = _best_guess_iso_3(c)
-            if iso2 not in _iso_2_cache:
-                _iso_2_cache[iso2] = set()
-            if iso3 not in _iso_3_cache:
-                _iso_3_cache[iso3] = set()
-            _iso_2_cache[iso2].add(c)
-            _iso_3_cache[iso3].add(c)
-
-
-def country_subunits_containing_point(lon, lat):
+def country_subunits_intersecting_bbox(lon1, lat1, lon2, lat2):
     """
-    Iterate over the country subunits that contain the provided point.
-    Each subunit will have a .bbox field indicating its (lon1, lat1, lon2,
-    lat2) bounding box.
+    Iterate over the country subunits whose bounding boxes intersect the
+    provided (lon1, lat1, lon2, lat2) box, edges included. A box with lon1
+    greater than lon2 is taken to cross the international date line.
+    """
+    return _window_query(lon1, lat1, lon2, lat2, within=False)
+
 
+def country_subunits_within_bbox(lon1, lat1, lon2, lat2):
     """
-    res = []
-    for c in countries:
-        (lon1, lat1, lon2, lat2) = c.bbox
+    Iterate over the country subunits whose bounding boxes lie entirely
+    inside the provided (lon1, lat1, lon2, lat2) box, edges included. A box
+    with lon1 greater than lon2 is taken to cross the international date
+    line.
+    """
+    return _window_query(lon1, lat1, lon2, lat2, within=True)
+
 
-        # To handle international date line spanning
-        # bboxes -- namely Fiji -- we treat any country that's
-        #
-        # Fiji spans the international date line
-        # (-180.0, -21.705859375, 180.0, -12.476953125),
-        #
-        # England does not
-        # (-5.65625, 50.0213867188, 1.74658203125, 55.8079589844),
-        #
-        # This poses a bit of difficulty, because they both appear
-        # "numerically" the same way, as a bounding box going from low
-        # longitude to high longitude. The problem is that passing the
-        # international date line means you should interpret the box
-        # as running from high to low
-
-        if lon1 <= lon and lon <= lon2 and \
-           lat1 <= lat and lat <= lat2:
-            res.append(c)
-    return iter(res)
+_distances = {
+    'great_circle': box_distance_km,
+    'planar': box_distance_degrees,
+}
+
+
+def _finite(lon, lat):
+    # False for a NaN or infinite coordinate (x - x is NaN for both), which
+    # no distance can be measured from.
+    return lon - lon == 0 and lat - lat == 0
+
+
+def country_subunits_nearest_to_point(lon, lat, k=1, max_distance=None,
+                                      metric='great_circle'):
+    """
+    Iterate over (distance, subunit) pairs for the k country subunits whose
+    bounding boxes are nearest the provided point, nearest first. With the
+    default 'great_circle' metric distances are in km; with 'planar' they
+    are in degrees of lon/lat. Subunits containing the point are at
+    distance 0, and any further than max_distance are left out. A point
+    with a NaN or infinite coordinate is near nothing.
+    """
+    if metric not in _distances:
+        raise ValueError("unknown metric %r" % (metric, ))
+    if k != int(k):
+        raise ValueError("k must be an integer")
+    if not _finite(lon, lat):
+        return iter([])
+    hits = _rtree_index().nearest(lon, lat, k, max_distance,
+                                  _distances[metric])
+    return iter([(d, countries[i]) for (d, i) in hits])
+
+
+def country_subunits_within_distance(lon, lat, distance_km):
+    """
+    Iterate over the country subunits whose bounding boxes come within
+    distance_km of the provided point, measured along the surface of the
+    earth (so across the international date line and over the poles as
+    need be). Subunits containing the point are always included, and a
+    point with a NaN or infinite coordinate is within reach of none.
+    distance_km must not be negative.
+    """
+    if not distance_km >= 0:
+        raise ValueError("distance_km must not be negative")
+    if not _finite(lon, lat):
+        return iter([])
+    return iter([countries[i] for i in
+                 _rtree_index().query_distance(lon, lat, distance_km)])
 
 
 def country_subunits_by_iso_code(code):
@@ -127,13 +365,7 @@ def country_subunits_by_iso_code(code):
     """
     if not isinstance(code, string_types):
         return iter([])
-    _ensure_caches_populated()
-    code = code.upper()
-    if len(code) == 2 and code in _iso_2_cache:
-            return iter(_iso_2_cache[code])
-    elif len(code) == 3 and code in _iso_3_cache:
-            return iter(_iso_3_cache[code])
-    return iter([])
+    return iter(_iso_subunits(code.upper()))
 
 
 def all_country_subunits():
@@ -145,14 +377,29 @@ def all_country_subunits():
     return iter(countries)
 
 
+def country_subunit_columns():
+    """
+    Return the whole dataset as columns rather than records: an object
+    with one column per field (plus lon1, lat1, lon2 and lat2 for the
+    bbox edges), available as attributes or by name, where position i of
+    every column describes the i'th subunit of all_country_subunits().
+    Numeric columns such as pop_est and gdp_md_est are array('d'), others
+    are lists of interned strings.
+    """
+    global _columns
+    if _columns is None:
+        _columns = _data.Columns(countries)
+    return _columns
+
+
 def all_country_subunits_grouped_by_iso_3_code():
     """
     Iterate over pairs of strings and sets of country subunits, where the
     string is an ISO 3166 alpha3 country code and the subunits all have a
     .bbox field indicating their (lon1, lat1, lon2, lat2) bounding box.
     """
-    _ensure_caches_populated()
-    return _iso_3_cache.items()
+    (_, iso_3_cache) = _ensure_caches_populated()
+    return dict((code, set(cs)) for (code, cs) in iso_3_cache.items()).items()
 
 
 def show_all_bounding_boxes():
@@ -178,125 +425,3 @@ def show_all_bounding_boxes():
               features=fs)
 
     print(json.dumps(fc, indent=True))
-
-
-# Discrepancies / missing units from the naturalearth data set
-def adjust_countries():
-
-    new_subunits = []
-
-    for (i, c) in enumerate(countries):
-
-        # Adjust Madeira bounding box to include to the island of Porto Santo
-        # by adding 1 degree to edges.
-        if c.gu_a3 == "PMD":
-            countries[i] = c._replace(bbox=(-17.3, 32.4, -16.25, 33.15))
-
-        # Add a subunit to Italy for the Pelagie Islands based on Pantelleria
-        # (an adjacent island with similar relationship to the Italian
-        # mainland). The Pelagie Islands are administered by the province of
-        # Agrigento (AG).
-        elif c.subunit == "Pantelleria":
-            n = c._replace(bbox=(12.315, 35.487, 12.893, 35.885),
-                           subunit="Pelagie Islands",
-                           name="Pelagie Islands",
-                           name_long="Pelagie Islands",
-                           brk_name="Pelagie Islands",
-                           su_a3="IAG",
-                           brk_a3="IAG",
-                           abbrev="Pel.",
-                           postal="",   # No idea what to put for 'postal'
-                           pop_est=6066.0,
-                           gdp_md_est=-99.0,
-                           lastcensus=2004,
-                           name_len=15.0,
-                           long_len=15.0,
-                           abbrev_len=4.0)
-            new_subunits.append(n)
-
-        # Add a subunit for Tuvalu based on Kiribati (the island it used to be
-        # part of, as the Ellice Islands).
-        elif c.subunit == "Kiribati":
-            n = c._replace(bbox=(176.7, -12.7, 180.0, -5.4),
-                           sovereignt="Tuvalu",
-                           sov_a3="TUV",
-                           admin="Tuvalu",
-                           adm0_a3="TUV",
-                           geounit="Tuvalu",
-                           gu_a3="TUV",
-                           subunit="Tuvalu",
-                           su_a3="TUV",
-                           name="Tuvalu",
-                           name_long="Tuvalu",
-                           brk_a3="TUV",
-                           brk_name="Tuvalu",
-                           abbrev="Tuvalu",
-                           postal="TV",
-                           formal_en="Tuvalu",
-                           name_sort="Tuvalu",
-                           pop_est=10837.0,
-                           gdp_md_est=3400.0,
-                           lastcensus=2012.0,
-                           iso_a2="TV",
-                           iso_a3="TUV",
-                           iso_n3="789",
-                           un_a3="789",
-                           wb_a2="TV",
-                           wb_a3="TUV",
-                           adm0_a3_is="TUV",
-                           adm0_a3_us="TUV",
-                           name_len=6.0,
-                           long_len=6.0,
-                           abbrev_len=6.0)
-            new_subunits.append(n)
-
-        # Add a subunit for the Archipelago of San Andrés, Providencia and
-        # Santa Catalina, based on Colombia. The achipelago has (as far as
-        # I can tell) no international status beyond "department of Colombia";
-        # no ISO code of its own or anything.
-        elif c.subunit == "Colombia":
-            n = c._replace(bbox=(-82.39, 11.16, -79.60, 15.33),
-                           pop_est=75167,
-                           formal_en=("Department of San Andrés"
-                                      + " and Providencia"))
-            new_subunits.append(n)
-
-        # Add a subunit for Gibraltar, based on the British Virgin Islands
-        # (another similarly-populated "overseas territory" of the UK).
-        elif c.subunit == "British Virgin Islands":
-            n = c._replace(bbox=(-5.368, 36.108618, -5.336, 36.155),
-                           pop_est=30001,
-                           admin="Gibraltar",
-                           adm0_a3="GIB",
-                           geounit="Gibraltar",
-                           gu_a3="GIB",
-                           subunit="Gibraltar",
-                           su_a3="GIB",
-                           name="Gibraltar",
-                           name_long="Gibraltar",
-                           brk_a3="GIB",
-                           brk_name="Gibraltar",
-                           abbrev="Gibraltar",
-                           postal="GI",
-                           formal_en="Gibraltar",
-                           name_sort="Gibraltar",
-                           gdp_md_est=45834,
-                           iso_a2="GI",
-                           iso_a3="GIB",
-                           iso_n3="292",
-                           un_a3="292",
-                           adm0_a3_is="GIB",
-                           adm0_a3_us="GIB",
-                           continent="Europe",
-                           region_un="Europe",
-                           subregion="Southern Europe",
-                           region_wb="Europe & Central Asia",
-                           name_len=9.0,
-                           long_len=9.0,
-                           abbrev_len=9.0)
-            new_subunits.append(n)
-
-    countries.extend(new_subunits)
-
-
-adjust_countries()
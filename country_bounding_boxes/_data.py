@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# The compact binary form of the country data, written by parse.py next to
+# generated.py and loaded by the package in its place. Unmarshalling the
+# half-megabyte generated module and building several hundred 64-field
+# namedtuples dominates import time; this file is a few flat arrays that
+# are memory-mapped and read in place, so loading it takes the same time
+# however large the dataset, and its pages are shared between processes
+# through the OS page cache. Country records are only built when asked
+# for, and anything else decoded from the file only when first used.
+#
+# Layout (all integers and floats little-endian, sections 8-byte aligned):
+#
+#   header   magic "CBBD", u16 version, u16 reserved, u32 rows,
+#            u32 fields, u32 values, then u32 offsets of the sections
+#            below, in order
+#   fields   u16 value id of each field name (the fields after bbox)
+#   bboxes   rows x 4 float64 (lon1, lat1, lon2, lat2)
+#   cells    rows x fields u16 value ids, row-major
+#   kinds    u8 per value: 0 string, 1 float, 2 int
+#   numbers  float64 per value (0.0 for strings)
+#   strofs   u32 per value + 1, offsets into the string blob
+#   strings  UTF-8 string blob
+#   iso2     u32 count, then that many (u16 code value id, u16 row) pairs
+#            giving the subunits under each ISO alpha2 code; a code id
+#            of 0xffff stands for None (no code)
+#   iso3     the same for ISO alpha3 codes
+#   quad     u32 top depth, u32 max depth, u32 cell count, then that many
+#            u32 cell references of the precomputed point lookup table
+#            (see index.QuadkeyIndex); a count of 0 means there is none
+#   qsplits  u32 count, then that many u32 references, four per
+#            subdivided cell
+#   qlists   u32 count, then that many + 1 u32 offsets into the u16 row
+#            numbers that follow
+#   rtree    u32 nodes, u32 leaf start, u32 capacity, u32 items, then
+#            nodes x 4 float64 node boxes, nodes x 2 u32 child ranges
+#            and items u16 rows of the R-tree over the bboxes (see
+#            index.STRTree); 0 nodes means there is none
+#
+# Every distinct value in the dataset appears once in the value table, so
+# repeated strings ("-99", "Africa", ...) are stored and decoded once.
+
+import mmap
+import os.path
+import struct
+import sys
+from array import array
+from collections import OrderedDict, namedtuple
+
+MAGIC = b'CBBD'
+VERSION = 4
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'countries.dat')
+
+_HEADER = struct.Struct('<4sHHIII13I')
+_NO_CODE = 0xffff
+_STRING, _FLOAT, _INT = 0, 1, 2
+
+if sys.version_info > (3, ):
+    text_type = str
+else:
+    text_type = unicode
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _le_array(typecode, values):
+    a = array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def _to_bytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _from_bytes(typecode, data):
+    a = array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def write(path, fields, rows, iso_2_index=(), iso_3_index=(),
+          quadkeys=None, rtree=None):
+    """
+    Write the data file. fields are the Country field names after bbox;
+    rows are sequences of (bbox, value, ...) such as Country records. The
+    ISO indexes are sequences of (code, row) pairs, with None for rows that
+    have no code. quadkeys and rtree are an index.QuadkeyIndex and
+    index.STRTree built from the rows' boxes, if any.
+    """
+    value_ids = {}
+    kinds = []
+    numbers = []
+    strings = []
+
+    def intern(v):
+        # Keyed on type as well, so that 1 and 1.0 stay distinct.
+        k = (type(v), v)
+        if k not in value_ids:
+            value_ids[k] = len(kinds)
+            if isinstance(v, (bytes, text_type)):
+                if isinstance(v, bytes):
+                    v = v.decode('utf-8')
+                kinds.append(_STRING)
+                numbers.append(0.0)
+                strings.append(v.encode('utf-8'))
+            else:
+                kinds.append(_INT if isinstance(v, int) else _FLOAT)
+                numbers.append(float(v))
+                strings.append(b'')
+        return value_ids[k]
+
+    field_ids = [intern(f) for f in fields]
+    bboxes = []
+    cells = []
+    for r in rows:
+        assert len(r) == len(fields) + 1
+        bboxes.extend(float(x) for x in r[0])
+        cells.extend(intern(v) for v in r[1:])
+
+    def index(pairs):
+        flat = []
+        for (code, row) in pairs:
+            flat.extend([_NO_CODE if code is None else intern(code), row])
+        return struct.pack('<I', len(flat) // 2) + \
+            _to_bytes(_le_array('H', flat))
+
+    iso_sections = [index(iso_2_index), index(iso_3_index)]
+
+    if quadkeys is None:
+        quad_sections = [struct.pack('<III', 0, 0, 0),
+                         struct.pack('<I', 0),
+                         struct.pack('<II', 0, 0)]
+    else:
+        quad_sections = [
+            struct.pack('<III', quadkeys.top_depth, quadkeys.max_depth,
+                        len(quadkeys.cells)) +
+            _to_bytes(_le_array('I', quadkeys.cells)),
+            struct.pack('<I', len(quadkeys.splits)) +
+            _to_bytes(_le_array('I', quadkeys.splits)),
+            struct.pack('<I', len(quadkeys.list_offsets) - 1) +
+            _to_bytes(_le_array('I', quadkeys.list_offsets)) +
+            _to_bytes(_le_array('H', quadkeys.list_items))]
+
+    if rtree is None or not rtree.links:
+        rtree_section = struct.pack('<IIII', 0, 0, 0, 0)
+    else:
+        rtree_section = (
+            struct.pack('<IIII', len(rtree.links) // 2, rtree.leaf_start,
+                        rtree.capacity, len(rtree.items)) +
+            _to_bytes(_le_array('d', rtree.boxes)) +
+            _to_bytes(_le_array('I', rtree.links)) +
+            _to_bytes(_le_array('H', rtree.items)))
+    assert len(kinds) < _NO_CODE
+
+    strofs = [0]
+    for s in strings:
+        strofs.append(strofs[-1] + len(s))
+
+    sections = [_to_bytes(_le_array('H', field_ids)),
+                _to_bytes(_le_array('d', bboxes)),
+                _to_bytes(_le_array('H', cells)),
+                _to_bytes(array('B', kinds)),
+                _to_bytes(_le_array('d', numbers)),
+                _to_bytes(_le_array('I', strofs)),
+                b''.join(strings)] + iso_sections + quad_sections + \
+        [rtree_section]
+    offsets = []
+    pos = _align(_HEADER.size)
+    for s in sections:
+        offsets.append(pos)
+        pos = _align(pos + len(s))
+
+    with open(path, 'wb') as out:
+        out.write(_HEADER.pack(MAGIC, VERSION, 0, len(rows), len(fields),
+                               len(kinds), *offsets))
+        for (off, s) in zip(offsets, sections):
+            out.write(b'\0' * (off - out.tell()))
+            out.write(s)
+
+
+# Whether arrays in the file can be read in place: memoryview.cast needs
+# Python 3, and the data must already be in native byte order. Otherwise
+# they are copied out.
+_ZERO_COPY = hasattr(memoryview, 'cast') and sys.byteorder == 'little'
+
+
+class Table(object):
+    """
+    The loaded data file: bounding boxes plus the row x field grid of
+    value ids, with values decoded on first use.
+
+    data is the file's contents, or a memory map of it. Where the
+    platform allows, the table reads its arrays from data in place rather
+    than copying them. With shared=True, decoded values are not kept
+    either, so that the process holds next to nothing of the dataset
+    beyond the pages of the file it shares with every other.
+    """
+
+    def __init__(self, data, shared=False):
+        (magic, version, _, self.rows, nfields, nvalues) = \
+            _HEADER.unpack_from(data)[:6]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a version %d country data file" % VERSION)
+        self._data = data
+        self._offsets = _HEADER.unpack_from(data)[6:] + (len(data),)
+        self._whole = memoryview(data) if _ZERO_COPY else data
+
+        self._kinds = self._section(3, 'B', nvalues)
+        self._numbers = self._section(4, 'd', nvalues)
+        self._strofs = self._section(5, 'I', nvalues + 1)
+        self._strings = self._whole[self._offsets[6]:
+                                    self._offsets[6] + self._strofs[-1]]
+        self._values = None if shared else [None] * nvalues
+
+        self.fields = tuple(self.value(v)
+                            for v in self._section(0, 'H', nfields))
+        self.field_index = dict((f, k) for (k, f) in enumerate(self.fields))
+        self._cells = self._section(2, 'H', self.rows * nfields)
+        self.Country = namedtuple('Country', ('bbox',) + self.fields)
+        self.Record = _record_class(self)
+
+        # Built from the file on first use.
+        self._bboxes = None
+        self._iso_indexes = {}
+
+        # The point lookup table, as the arguments to QuadkeyIndex after
+        # the boxes.
+        (top_depth, max_depth, ncells) = \
+            struct.unpack_from('<III', data, self._offsets[9])
+        if ncells:
+            cells = self._view('I', self._offsets[9] + 12, ncells)
+            (nsplits, ) = struct.unpack_from('<I', data, self._offsets[10])
+            splits = self._view('I', self._offsets[10] + 4, nsplits)
+            (nlists, ) = struct.unpack_from('<I', data, self._offsets[11])
+            listofs = self._view('I', self._offsets[11] + 4, nlists + 1)
+            items = self._view('H', self._offsets[11] + 4 * (nlists + 2),
+                               listofs[-1])
+            self.quadkeys = (top_depth, max_depth, cells, splits, listofs,
+                             items)
+        else:
+            self.quadkeys = None
+
+        # The R-tree, as the arguments to STRTree.from_arrays after the
+        # boxes.
+        start = self._offsets[12]
+        (nnodes, leaf_start, capacity, nitems) = \
+            struct.unpack_from('<IIII', data, start)
+        if nnodes:
+            boxes = self._view('d', start + 16, nnodes * 4)
+            links = self._view('I', start + 16 + nnodes * 32, nnodes * 2)
+            items = self._view('H', start + 16 + nnodes * 40, nitems)
+            self.rtree = (capacity, leaf_start, boxes, links, items)
+        else:
+            self.rtree = None
+
+    def _view(self, typecode, start, count):
+        # count items of the given type at start, read in place if
+        # possible.
+        end = start + count * array(typecode).itemsize
+        if _ZERO_COPY:
+            return self._whole[start:end].cast(typecode)
+        return _from_bytes(typecode, self._data[start:end])
+
+    def _section(self, k, typecode, count):
+        return self._view(typecode, self._offsets[k], count)
+
+    @property
+    def bboxes(self):
+        b = self._bboxes
+        if b is None:
+            flat = self._section(1, 'd', self.rows * 4)
+            b = self._bboxes = [tuple(flat[i:i + 4])
+                                for i in range(0, len(flat), 4)]
+        return b
+
+    def _iso_index(self, k):
+        res = self._iso_indexes.get(k)
+        if res is None:
+            # Copied out in one go, as (code, row) pairs grouped by the
+            # code's value number, so that each code is decoded just once.
+            start = self._offsets[k] + 4
+            (count, ) = struct.unpack_from('<I', self._data, start - 4)
+            flat = _from_bytes('H', self._data[start:start + count * 4])
+            rows = {}
+            for (v, row) in zip(flat[0::2], flat[1::2]):
+                rows.setdefault(v, []).append(row)
+            res = self._iso_indexes[k] = dict(
+                (None if v == _NO_CODE else self.value(v), tuple(rs))
+                for (v, rs) in rows.items())
+        return res
+
+    @property
+    def iso_2_index(self):
+        return self._iso_index(7)
+
+    @property
+    def iso_3_index(self):
+        return self._iso_index(8)
+
+    def value(self, v):
+        values = self._values
+        if values is not None and values[v] is not None:
+            return values[v]
+        kind = self._kinds[v]
+        if kind == _STRING:
+            x = bytes(self._strings[self._strofs[v]:
+                                    self._strofs[v + 1]]).decode('utf-8')
+            if str is bytes:
+                x = x.encode('utf-8')
+        elif kind == _INT:
+            x = int(self._numbers[v])
+        else:
+            x = self._numbers[v]
+        if values is not None:
+            values[v] = x
+        return x
+
+    def get(self, row, field):
+        nfields = len(self.fields)
+        return self.value(self._cells[row * nfields + self.field_index[field]])
+
+    def country(self, row):
+        nfields = len(self.fields)
+        ids = self._cells[row * nfields:(row + 1) * nfields]
+        return self.Country(self.bboxes[row], *[self.value(v) for v in ids])
+
+    def record(self, row):
+        return self.Record(self.bboxes[row], row)
+
+
+class Record(object):
+    """
+    A lightweight stand-in for a Country namedtuple that holds only its
+    bbox and row number; every other field is read from the Table when
+    accessed. It supports the same attribute, sequence, equality and
+    _asdict/_replace API, and pickles as a plain Country.
+    """
+
+    __slots__ = ('bbox', '_row')
+
+    _table = None
+    _fields = ()
+
+    def __init__(self, bbox, row):
+        self.bbox = bbox
+        self._row = row
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        yield self.bbox
+        for f in self._fields[1:]:
+            yield getattr(self, f)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return tuple(self)[k]
+        # A single field is read on its own, without decoding the rest.
+        f = self._fields[k]
+        return self.bbox if f == 'bbox' else getattr(self, f)
+
+    def __eq__(self, other):
+        if isinstance(other, Record) and other._table is self._table and \
+           other._row == self._row:
+            return True
+        if not isinstance(other, (tuple, Record)):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    # Ordered as tuples, like the namedtuple it stands in for.
+
+    def __lt__(self, other):
+        if not isinstance(other, (tuple, Record)):
+            return NotImplemented
+        return tuple(self) < tuple(other)
+
+    def __le__(self, other):
+        if not isinstance(other, (tuple, Record)):
+            return NotImplemented
+        return tuple(self) <= tuple(other)
+
+    def __gt__(self, other):
+        if not isinstance(other, (tuple, Record)):
+            return NotImplemented
+        return tuple(self) > tuple(other)
+
+    def __ge__(self, other):
+        if not isinstance(other, (tuple, Record)):
+            return NotImplemented
+        return tuple(self) >= tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return 'Country(%s)' % ', '.join('%s=%r' % (f, v) for (f, v)
+                                         in zip(self._fields, self))
+
+    def __reduce__(self):
+        return (self._table.Country, tuple(self))
+
+    def _asdict(self):
+        return OrderedDict(zip(self._fields, self))
+
+    def _replace(self, **kwargs):
+        return self._table.Country(*self)._replace(**kwargs)
+
+    def count(self, value):
+        return tuple(self).count(value)
+
+    def index(self, value):
+        return tuple(self).index(value)
+
+
+def _field_property(k):
+    def get(self):
+        t = self._table
+        return t.value(t._cells[self._row * len(t.fields) + k])
+    return property(get)
+
+
+def _record_class(table):
+    # A Record subclass bound to the table, with a property per field.
+    d = dict(__slots__=(), _table=table, _fields=('bbox',) + table.fields)
+    for (k, f) in enumerate(table.fields):
+        d[f] = _field_property(k)
+    return type('Country', (Record,), d)
+
+
+def load(path=DATA_FILE, shared=False):
+    """
+    Load the data file, memory-mapped read-only so that every process
+    using it shares one copy in the OS page cache. shared is as for Table.
+    """
+    with open(path, 'rb') as f:
+        return Table(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),
+                     shared)
+
+
+class CountryList(object):
+    """
+    A read-only list of Country records backed by a Table, creating each
+    (lightweight) record the first time it is accessed.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._records = [None] * table.rows
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self._records)))]
+        c = self._records[i]
+        if c is None:
+            if i < 0:
+                i += len(self._records)
+            c = self._records[i] = self.table.record(i)
+        return c
+
+    def __iter__(self):
+        for i in range(len(self._records)):
+            yield self[i]
+
+    def bboxes(self):
+        return self.table.bboxes
+
+    def column(self, field):
+        return [self.table.get(i, field) for i in range(len(self._records))]
+
+
+if sys.version_info > (3, ):
+    _intern = sys.intern
+else:
+    _intern = intern
+
+
+class Columns(object):
+    """
+    A structure-of-arrays view of a CountryList: one column per field,
+    with position i of every column describing record i. The bbox edges
+    are available as the lon1, lat1, lon2 and lat2 columns. Numeric
+    columns are array('d'); the rest are lists of interned strings, so
+    equal values are the same object. Columns are built on first access.
+    """
+
+    def __init__(self, countries):
+        self._countries = countries
+        self._columns = {}
+        self.fields = ('lon1', 'lat1', 'lon2', 'lat2') + \
+            countries.table.fields
+
+    def __len__(self):
+        return len(self._countries)
+
+    def __getitem__(self, field):
+        col = self._columns.get(field)
+        if col is None:
+            col = self._build(field)
+            self._columns[field] = col
+        return col
+
+    def __getattr__(self, field):
+        if field.startswith('_') or field not in self.fields:
+            raise AttributeError(field)
+        return self[field]
+
+    def _build(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+        k = self.fields.index(field)
+        if k < 4:
+            return array('d', [b[k] for b in self._countries.bboxes()])
+        values = self._countries.column(field)
+        if all(isinstance(v, (int, float)) for v in values):
+            return array('d', values)
+        return [_intern(v) if isinstance(v, str) else v for v in values]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Simplified outlines of the country subunits, for telling apart the
+# subunits whose bounding boxes overlap. parse.py writes them from the
+# shapefile's polygons at several levels of detail, one file per level
+# named after the Natural Earth scale it matches; the package loads each
+# only when a precise lookup at that level is first asked for.
+#
+# Layout (all little-endian, sections 8-byte aligned):
+#
+#   header   magic "CBBP", u16 version, u16 reserved, u32 rows,
+#            u32 rings, u32 points, then u32 offsets of the sections
+#            below, in order
+#   rows     u32 per row + 1: row r has rings rows[r]:rows[r + 1]
+#   rings    u32 per ring + 1: ring k has points rings[k]:rings[k + 1]
+#   boxes    rings x 4 int32 (lon1, lat1, lon2, lat2) per ring
+#   lons     int32 per point
+#   lats     int32 per point
+#
+# Coordinates are fixed-point, in units of 1e-7 degrees. Rows line up with
+# those of the country data file; a row with no rings (such as a subunit
+# added by patches.json) has no outline, and is taken to fill its box.
+
+import os.path
+import struct
+
+from country_bounding_boxes._data import _align, _from_bytes, _le_array, \
+    _to_bytes
+
+MAGIC = b'CBBP'
+VERSION = 1
+LEVELS = ('10m', '50m', '110m')
+DEFAULT_LEVEL = '50m'
+
+SCALE = 1e7
+
+_HEADER = struct.Struct('<4sHHIII5I')
+
+
+class MissingOutlines(IOError):
+    """
+    Raised when a precise lookup needs outlines that are not installed.
+    """
+
+
+def polygon_file(level):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'polygons_%s.dat' % level)
+
+
+def _fixed(x):
+    return int(round(x * SCALE))
+
+
+def write(path, rows):
+    """
+    Write the polygon file. rows holds, for each row of the country data,
+    a list of rings, each a list of (lon, lat) points.
+    """
+    row_ofs = [0]
+    ring_ofs = [0]
+    boxes = []
+    lons = []
+    lats = []
+    for rings in rows:
+        for ring in rings:
+            xs = [_fixed(p[0]) for p in ring]
+            ys = [_fixed(p[1]) for p in ring]
+            lons.extend(xs)
+            lats.extend(ys)
+            boxes.extend([min(xs), min(ys), max(xs), max(ys)])
+            ring_ofs.append(len(lons))
+        row_ofs.append(len(ring_ofs) - 1)
+
+    sections = [_to_bytes(_le_array('I', row_ofs)),
+                _to_bytes(_le_array('I', ring_ofs)),
+                _to_bytes(_le_array('i', boxes)),
+                _to_bytes(_le_array('i', lons)),
+                _to_bytes(_le_array('i', lats))]
+    offsets = []
+    pos = _align(_HEADER.size)
+    for s in sections:
+        offsets.append(pos)
+        pos = _align(pos + len(s))
+
+    with open(path, 'wb') as out:
+        out.write(_HEADER.pack(MAGIC, VERSION, 0, len(rows),
+                               len(ring_ofs) - 1, len(lons), *offsets))
+        for (off, s) in zip(offsets, sections):
+            out.write(b'\0' * (off - out.tell()))
+            out.write(s)
+
+
+class Polygons(object):
+    """
+    The loaded polygon file.
+    """
+
+    def __init__(self, data):
+        header = _HEADER.unpack_from(data)
+        (magic, version, _, self.rows, nrings, npoints) = header[:6]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a version %d polygon file" % VERSION)
+        offsets = header[6:]
+
+        def section(k, typecode, count):
+            start = offsets[k]
+            return _from_bytes(typecode, data[start:start + count * 4])
+
+        self._rows = section(0, 'I', self.rows + 1)
+        self._rings = section(1, 'I', nrings + 1)
+        self._boxes = section(2, 'i', nrings * 4)
+        self._lons = section(3, 'i', npoints)
+        self._lats = section(4, 'i', npoints)
+
+    def has_outline(self, row):
+        return self._rows[row] != self._rows[row + 1]
+
+    def contains(self, row, lon, lat):
+        """
+        Whether the point is inside the outline of the row, by the
+        even-odd rule over all its rings (so holes count as outside). Rows
+        without an outline contain every point; the caller is expected to
+        have checked the bounding box first.
+        """
+        if not self.has_outline(row):
+            return True
+        x = lon * SCALE
+        y = lat * SCALE
+        boxes = self._boxes
+        inside = False
+        for k in range(self._rows[row], self._rows[row + 1]):
+            b = 4 * k
+            if boxes[b] <= x <= boxes[b + 2] and \
+               boxes[b + 1] <= y <= boxes[b + 3] and \
+               self._ring_contains(k, x, y):
+                inside = not inside
+        return inside
+
+    def _ring_contains(self, k, x, y):
+        # Cast a ray from the point towards +x and count the edges it
+        # crosses.
+        lons = self._lons
+        lats = self._lats
+        start = self._rings[k]
+        end = self._rings[k + 1]
+        inside = False
+        j = end - 1
+        for i in range(start, end):
+            yi = lats[i]
+            yj = lats[j]
+            if (yi > y) != (yj > y):
+                xi = lons[i]
+                if x < xi + (lons[j] - xi) * (y - yi) / float(yj - yi):
+                    inside = not inside
+            j = i
+        return inside
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return Polygons(f.read())
+
+
+def load_level(level):
+    """
+    Load the outlines at level, raising MissingOutlines if their file has
+    not been built.
+    """
+    path = polygon_file(level)
+    if not os.path.exists(path):
+        raise MissingOutlines(
+            "no subunit outlines at resolution %r: %s is not installed; "
+            "build it by running parse.py (which downloads the Natural "
+            "Earth shapefiles) in a source checkout"
+            % (level, os.path.basename(path)))
+    return load(path)
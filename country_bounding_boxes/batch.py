@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Vectorized lookups over many points at once. This module needs NumPy,
+# which is an optional extra:
+#
+#     $ pip install country-bounding-boxes[numpy]
+
+import numpy as np
+
+from country_bounding_boxes import countries
+
+# Number of points compared against all the boxes at once; bounds the
+# size of the (points x boxes) comparison matrices, which stay small
+# enough to be cache-resident.
+DEFAULT_CHUNK_SIZE = 2048
+
+# The bounding boxes as four contiguous float64 columns (lon1, lat1, lon2,
+# lat2), built on first use.
+_columns = None
+
+
+def _bbox_columns():
+    global _columns
+    if _columns is None:
+        boxes = np.array(countries.bboxes(),
+                         dtype=np.float64).reshape(-1, 4)
+        _columns = tuple(np.ascontiguousarray(boxes[:, k])
+                         for k in range(4))
+    return _columns
+
+
+def country_subunits_containing_points(lons, lats,
+                                       chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Look up many points at once. Takes equal-length arrays of longitudes
+    and latitudes and returns a CSR-style pair (offsets, indices) of
+    integer arrays: the subunits containing point k are at positions
+    indices[offsets[k]:offsets[k + 1]] of all_country_subunits(), in the
+    same order country_subunits_containing_point would return them.
+    """
+    lons = np.asarray(lons, dtype=np.float64).ravel()
+    lats = np.asarray(lats, dtype=np.float64).ravel()
+    if lons.shape != lats.shape:
+        raise ValueError("lons and lats must have the same length")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+
+    (lon1, lat1, lon2, lat2) = _bbox_columns()
+    counts = np.zeros(len(lons), dtype=np.int64)
+    pieces = []
+    for s in range(0, len(lons), chunk_size):
+        x = lons[s:s + chunk_size, np.newaxis]
+        y = lats[s:s + chunk_size, np.newaxis]
+        hit = lon1 <= x
+        hit &= x <= lon2
+        hit &= lat1 <= y
+        hit &= y <= lat2
+        # Flat positions come out row-major, so each point's subunits are
+        # in dataset order; this is much faster than a 2-d nonzero.
+        (rows, cols) = np.divmod(np.flatnonzero(hit), hit.shape[1])
+        counts[s:s + chunk_size] = np.bincount(rows, minlength=len(x))
+        pieces.append(cols.astype(np.int32))
+
+    offsets = np.zeros(len(lons) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if pieces:
+        indices = np.concatenate(pieces)
+    else:
+        indices = np.zeros(0, dtype=np.int32)
+    return (offsets, indices)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Memoized point lookups, for traffic where the same places come up over
+# and over. Points are snapped to a grid of small cells and the answer is
+# remembered per cell, but only for cells that every bounding box either
+# covers entirely or misses entirely, so that snapping never changes the
+# answer. Points in cells straddling a box edge are looked up exactly
+# every time.
+
+import math
+import threading
+from collections import OrderedDict
+
+from country_bounding_boxes import _point_query, _rtree_index, \
+    _specificity_ranks, countries
+
+# Stands in the cache for a cell that straddles a box edge.
+_EDGE = object()
+
+# The finest precision allowed. Cells are widened by a millionth of their
+# size against rounding in working out a point's key; past 7 decimal
+# places that is no longer several times the spacing of floats near
+# lon 180, and the widening stops protecting anything.
+MAX_PRECISION = 7
+
+
+class PointCache(object):
+    """
+    A bounded, least-recently-used cache around
+    country_subunits_containing_point. Points are keyed on their
+    coordinates rounded down to precision decimal places (4, the default,
+    makes cells about 11 m across at the equator); at most maxsize cells
+    are remembered. hits and misses count the lookups answered from the
+    cache and the rest. precision must be an integer from 0 to
+    MAX_PRECISION. Safe to share between threads.
+    """
+
+    def __init__(self, precision=4, maxsize=65536):
+        if precision != int(precision) or \
+           not 0 <= precision <= MAX_PRECISION:
+            raise ValueError("precision must be an integer from 0 to %d"
+                             % MAX_PRECISION)
+        if maxsize < 1:
+            raise ValueError("maxsize must be positive")
+        self.precision = precision
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._scale = 10.0 ** precision
+        self._cells = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cells)
+
+    def clear(self):
+        """
+        Forget every cell and reset the counters.
+        """
+        with self._lock:
+            self._cells.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __call__(self, lon, lat, smallest_first=False):
+        """
+        Iterate over the country subunits whose bounding boxes contain the
+        provided point, exactly as country_subunits_containing_point does.
+        """
+        hits = self._lookup(lon, lat)
+        if smallest_first:
+            hits = sorted(hits, key=_specificity_ranks().__getitem__)
+        return iter([countries[i] for i in hits])
+
+    def _lookup(self, lon, lat):
+        if not (-180.0 <= lon <= 180.0 and -90.0 <= lat <= 90.0):
+            # Off the map (or NaN): not worth a cell of its own.
+            with self._lock:
+                self.misses += 1
+            return _point_query(lon, lat, False, None)
+        key = (int(math.floor(lon * self._scale)),
+               int(math.floor(lat * self._scale)))
+        with self._lock:
+            hits = self._cells.pop(key, None)
+            if hits is not None:
+                # Move to the most recently used end.
+                self._cells[key] = hits
+                if hits is not _EDGE:
+                    self.hits += 1
+                    return hits
+            self.misses += 1
+        if hits is None:
+            hits = self._cell_answer(key)
+            with self._lock:
+                self._cells[key] = hits
+                while len(self._cells) > self.maxsize:
+                    self._cells.popitem(last=False)
+        if hits is _EDGE:
+            return _point_query(lon, lat, False, None)
+        return hits
+
+    def _cell_answer(self, key):
+        # The positions of the boxes containing every point of the cell,
+        # or _EDGE if some box contains only part of it. The cell is
+        # widened a little so that rounding in working out a point's key
+        # cannot place it just outside the cell.
+        margin = 1e-6 / self._scale
+        lon1 = max(key[0] / self._scale - margin, -180.0)
+        lat1 = max(key[1] / self._scale - margin, -90.0)
+        lon2 = min((key[0] + 1) / self._scale + margin, 180.0)
+        lat2 = min((key[1] + 1) / self._scale + margin, 90.0)
+        tree = _rtree_index()
+        hits = tree.query_bbox((lon1, lat1, lon2, lat2))
+        for i in hits:
+            b = tree.bboxes[i]
+            if not (b[0] <= lon1 and lon2 <= b[2] and
+                    b[1] <= lat1 and lat2 <= b[3]):
+                return _EDGE
+        return tuple(hits)
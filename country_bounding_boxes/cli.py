@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Reverse geocoding of lon/lat streams from the command line:
+#
+#     $ python -m country_bounding_boxes points.csv > tagged.csv
+#     $ zcat log.ndjson.gz | python -m country_bounding_boxes -f ndjson
+#
+# Input is read and written a batch of rows at a time, so memory use stays
+# flat however long the stream is, and each batch's output goes out as one
+# write.
+
+import argparse
+import csv
+import io
+import json
+import sys
+from country_bounding_boxes import _point_query, _polygons, _preload, \
+    _specificity_ranks, countries
+from country_bounding_boxes.parallel import _batches, ordered_map
+
+# The columns (CSV) or keys (NDJSON) appended to every row.
+FIELDS = ('iso_a2', 'iso_a3', 'name')
+
+DEFAULT_BATCH_SIZE = 1024
+
+# Separates the values of several subunits in a CSV column, with --all.
+CSV_SEPARATOR = ';'
+
+
+def _row_codes(index):
+    # Invert an ISO index of the data file: the code of each row. Rows
+    # left out of the index as duplicates take the code of their twin.
+    codes = {}
+    for (code, rows) in index.items():
+        for r in rows:
+            codes[r] = code
+    twins = dict((countries[r], code) for (r, code) in codes.items())
+    return [codes.get(r, twins.get(countries[r])) or ''
+            for r in range(len(countries))]
+
+
+class Tagger(object):
+    """
+    Looks up points and returns, for each, the FIELDS of its subunits: the
+    most specific one by default, or all of them, smallest first, with
+    all_matches=True. ISO codes are those that country_subunits_by_iso_code
+    files each subunit under, so subunits with no code of their own in
+    the dataset still get their country's.
+    """
+
+    def __init__(self, all_matches=False, precise=False,
+                 resolution=_polygons.DEFAULT_LEVEL):
+        self.all_matches = all_matches
+        self.precise = precise
+        self.resolution = resolution
+        # Load everything up front, so that worker processes forked from
+        # this one start with it.
+        _preload(precise, resolution)
+        self.ranks = _specificity_ranks()
+        table = countries.table
+        self.labels = list(zip(_row_codes(table.iso_2_index),
+                               _row_codes(table.iso_3_index),
+                               countries.column('name')))
+
+    def tag(self, lon, lat):
+        hits = _point_query(lon, lat, self.precise, self.resolution)
+        if len(hits) > 1:
+            if self.all_matches:
+                hits.sort(key=self.ranks.__getitem__)
+            else:
+                hits = [min(hits, key=self.ranks.__getitem__)]
+        return [self.labels[i] for i in hits]
+
+
+def _coordinate(v):
+    # A longitude or latitude from the input, or None if it is missing or
+    # not a number.
+    try:
+        x = float(v)
+    except (TypeError, ValueError):
+        return None
+    return None if x != x else x
+
+
+def _csv_writer():
+    # A csv writer into a text buffer, on either Python.
+    out = io.BytesIO() if str is bytes else io.StringIO()
+    return (out, csv.writer(out, lineterminator='\n'))
+
+
+def tag_csv_rows(tagger, rows, lon_col, lat_col):
+    """
+    Return the CSV text of the rows (lists of strings) with the FIELDS of
+    each row's point appended; rows whose point is missing or malformed
+    get empty values.
+    """
+    (out, writer) = _csv_writer()
+    empty = ('', ) * len(FIELDS)
+    for row in rows:
+        lon = _coordinate(row[lon_col]) if lon_col < len(row) else None
+        lat = _coordinate(row[lat_col]) if lat_col < len(row) else None
+        labels = [] if lon is None or lat is None else tagger.tag(lon, lat)
+        if not labels:
+            values = empty
+        elif len(labels) == 1:
+            values = labels[0]
+        else:
+            values = [CSV_SEPARATOR.join(vs) for vs in zip(*labels)]
+        row.extend(values)
+        writer.writerow(row)
+    return out.getvalue()
+
+
+def tag_ndjson_lines(tagger, lines, lon_key, lat_key, first_line=1):
+    """
+    Return the NDJSON text of the lines (each a JSON object) with the
+    FIELDS of each object's point added, null when there is no match or
+    no valid point; with Tagger.all_matches each is a list instead. Blank
+    lines are dropped, and so are lines that are not JSON objects, with a
+    warning on stderr giving their line number (counting the first of
+    lines as first_line).
+    """
+    out = []
+    for (n, line) in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            obj = None
+        if not isinstance(obj, dict):
+            sys.stderr.write("line %d: not a JSON object, skipped\n" % n)
+            continue
+        lon = _coordinate(obj.get(lon_key))
+        lat = _coordinate(obj.get(lat_key))
+        labels = [] if lon is None or lat is None else tagger.tag(lon, lat)
+        if tagger.all_matches:
+            values = [list(vs) for vs in zip(*labels)] or \
+                [[] for _ in FIELDS]
+        else:
+            values = labels[0] if labels else (None, ) * len(FIELDS)
+        obj.update(zip(FIELDS, values))
+        out.append(json.dumps(obj, ensure_ascii=False,
+                              separators=(',', ':')))
+        out.append('\n')
+    return ''.join(out)
+
+
+def tag_stream(infile, outfile, fmt, tagger, lon_field='lon',
+               lat_field='lat', batch_size=DEFAULT_BATCH_SIZE,
+               header=True, jobs=1):
+    """
+    Tag every row of the text stream infile, in the format fmt ('csv' or
+    'ndjson'), writing the results to outfile as each batch of batch_size
+    rows is done. CSV input needs a header row naming the lon_field and
+    lat_field columns, which is copied to the output (with the FIELDS
+    added) unless header is false; NDJSON objects are looked up by those
+    keys, and lines that are not JSON objects are skipped with a warning
+    on stderr. With jobs greater than 1, batches are tagged by that many worker
+    processes, and written in input order.
+    """
+    if fmt == 'csv':
+        reader = csv.reader(infile)
+        columns = next(reader, None)
+        if columns is None:
+            return
+        for f in (lon_field, lat_field):
+            if f not in columns:
+                raise ValueError("no %r column in the CSV header" % (f, ))
+        if header:
+            (out, writer) = _csv_writer()
+            writer.writerow(columns + list(FIELDS))
+            outfile.write(out.getvalue())
+        tag = tag_csv_rows
+        (lon_field, lat_field) = (columns.index(lon_field),
+                                  columns.index(lat_field))
+        work = ((b, lon_field, lat_field)
+                for b in _batches(reader, batch_size))
+    elif fmt == 'ndjson':
+        # Each batch goes with the number of its first line, for the
+        # warnings about lines that cannot be tagged.
+        tag = tag_ndjson_lines
+        work = ((b, lon_field, lat_field, 1 + k * batch_size)
+                for (k, b) in enumerate(_batches(infile, batch_size)))
+    else:
+        raise ValueError("unknown format %r" % (fmt, ))
+
+    if jobs > 1:
+        global _worker_tagger
+        # Forked workers inherit the tagger and the indexes behind it.
+        _worker_tagger = tagger
+        results = ordered_map(
+            _tag_batch, ((tag, ) + args for args in work), jobs,
+            _init_worker,
+            (tagger.all_matches, tagger.precise, tagger.resolution))
+    else:
+        results = (tag(tagger, *args) for args in work)
+    for text in results:
+        outfile.write(text)
+        outfile.flush()
+
+
+# The Tagger used by worker processes.
+_worker_tagger = None
+
+
+def _init_worker(all_matches, precise, resolution):
+    global _worker_tagger
+    if _worker_tagger is None:
+        _worker_tagger = Tagger(all_matches, precise, resolution)
+
+
+def _tag_batch(args):
+    return args[0](_worker_tagger, *args[1:])
+
+
+def _guess_format(filename):
+    if filename.endswith(('.ndjson', '.jsonl', '.json')):
+        return 'ndjson'
+    return 'csv'
+
+
+def _open(filename, mode):
+    if filename == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if str is bytes:
+        return open(filename, mode + 'b')
+    return io.open(filename, mode, encoding='utf-8', newline='')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m country_bounding_boxes',
+        description="Append the ISO codes and name of the country subunit "
+                    "containing each point of CSV or NDJSON input.")
+    parser.add_argument('files', nargs='*', default=['-'],
+                        help="input files (default: standard input)")
+    parser.add_argument('-f', '--format', choices=['csv', 'ndjson'],
+                        help="input format (default: by file extension, "
+                             "else csv)")
+    parser.add_argument('-o', '--output', default='-',
+                        help="output file (default: standard output)")
+    parser.add_argument('--lon', default='lon', metavar='FIELD',
+                        help="longitude column or key (default: lon)")
+    parser.add_argument('--lat', default='lat', metavar='FIELD',
+                        help="latitude column or key (default: lat)")
+    parser.add_argument('--all', action='store_true',
+                        help="give every subunit containing the point, "
+                             "smallest first, rather than just the "
+                             "smallest")
+    parser.add_argument('--precise', action='store_true',
+                        help="check points against the subunit outlines")
+    parser.add_argument('--resolution', default=_polygons.DEFAULT_LEVEL,
+                        choices=_polygons.LEVELS,
+                        help="outline resolution for --precise")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="tag batches in N worker processes (default: "
+                             "1, in this process)")
+    parser.add_argument('--batch-size', type=int,
+                        default=DEFAULT_BATCH_SIZE, metavar='N',
+                        help="rows read, looked up and written at a time "
+                             "(default: %d)" % DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+    if args.batch_size < 1:
+        parser.error("--batch-size must be positive")
+    if args.jobs < 1:
+        parser.error("--jobs must be positive")
+
+    try:
+        tagger = Tagger(args.all, args.precise, args.resolution)
+    except _polygons.MissingOutlines as e:
+        parser.error(str(e))
+    outfile = _open(args.output, 'w')
+    try:
+        for (k, filename) in enumerate(args.files):
+            fmt = args.format or _guess_format(filename)
+            infile = _open(filename, 'r')
+            try:
+                # Concatenated CSV output keeps only the first header.
+                tag_stream(infile, outfile, fmt, tagger, args.lon, args.lat,
+                           args.batch_size, header=(k == 0),
+                           jobs=args.jobs)
+            except ValueError as e:
+                parser.error("%s: %s" % (filename, e))
+            finally:
+                if infile is not sys.stdin:
+                    infile.close()
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+    return 0
@@ -14583,7 +14583,7 @@ countries = [
         tiny=2.0,
         homepart=1.0),
     Country(
-        bbox=(-17.241015625, 32.6482910156, -16.6932617187, 32.8686035156),
+        bbox=(-17.3, 32.4, -16.25, 33.15),
         scalerank=3,
         featurecla="Admin-0 map subunit",
         labelrank=6.0,
@@ -20312,4 +20312,330 @@ countries = [
         abbrev_len=5.0,
         tiny=-99.0,
         homepart=1.0),
+    # Subunits added by patches.json
+    Country(
+        bbox=(-82.39, 11.16, -79.6, 15.33),
+        scalerank=1,
+        featurecla="Admin-0 map subunit",
+        labelrank=2.0,
+        sovereignt="Colombia",
+        sov_a3="COL",
+        adm0_dif=0.0,
+        level=2.0,
+        type="Sovereign country",
+        admin="Colombia",
+        adm0_a3="COL",
+        geou_dif=0.0,
+        geounit="Colombia",
+        gu_a3="COL",
+        su_dif=0.0,
+        subunit="Colombia",
+        su_a3="COL",
+        brk_diff=0.0,
+        name="Colombia",
+        name_long="Colombia",
+        brk_a3="COL",
+        brk_name="Colombia",
+        brk_group="",
+        abbrev="Col.",
+        postal="CO",
+        formal_en="Department of San Andrés and Providencia",
+        formal_fr="",
+        note_adm0="",
+        note_brk="",
+        name_sort="Colombia",
+        name_alt="",
+        mapcolor7=2.0,
+        mapcolor8=1.0,
+        mapcolor9=3.0,
+        mapcolor13=1.0,
+        pop_est=75167,
+        gdp_md_est=395400.0,
+        pop_year=-99.0,
+        lastcensus=2006.0,
+        gdp_year=-99.0,
+        economy="6. Developing region",
+        income_grp="3. Upper middle income",
+        wikipedia=-99.0,
+        fips_10="",
+        iso_a2="CO",
+        iso_a3="COL",
+        iso_n3="170",
+        un_a3="170",
+        wb_a2="CO",
+        wb_a3="COL",
+        woe_id=-99.0,
+        adm0_a3_is="COL",
+        adm0_a3_us="COL",
+        adm0_a3_un=-99.0,
+        adm0_a3_wb=-99.0,
+        continent="South America",
+        region_un="Americas",
+        subregion="South America",
+        region_wb="Latin America & Caribbean",
+        name_len=8.0,
+        long_len=8.0,
+        abbrev_len=4.0,
+        tiny=-99.0,
+        homepart=1.0),
+    Country(
+        bbox=(12.315, 35.487, 12.893, 35.885),
+        scalerank=3,
+        featurecla="Admin-0 map subunit",
+        labelrank=7.0,
+        sovereignt="Italy",
+        sov_a3="ITA",
+        adm0_dif=0.0,
+        level=4.0,
+        type="Geo subunit",
+        admin="Italy",
+        adm0_a3="ITA",
+        geou_dif=0.0,
+        geounit="Italy",
+        gu_a3="ITA",
+        su_dif=1.0,
+        subunit="Pelagie Islands",
+        su_a3="IAG",
+        brk_diff=0.0,
+        name="Pelagie Islands",
+        name_long="Pelagie Islands",
+        brk_a3="IAG",
+        brk_name="Pelagie Islands",
+        brk_group="",
+        abbrev="Pel.",
+        postal="",
+        formal_en="",
+        formal_fr="",
+        note_adm0="Italy",
+        note_brk="",
+        name_sort="Pantelleria",
+        name_alt="",
+        mapcolor7=6.0,
+        mapcolor8=7.0,
+        mapcolor9=8.0,
+        mapcolor13=7.0,
+        pop_est=6066.0,
+        gdp_md_est=-99.0,
+        pop_year=-99.0,
+        lastcensus=2004,
+        gdp_year=-99.0,
+        economy="-99",
+        income_grp="-99",
+        wikipedia=-99.0,
+        fips_10="",
+        iso_a2="-99",
+        iso_a3="-99",
+        iso_n3="-99",
+        un_a3="-099",
+        wb_a2="-99",
+        wb_a3="-99",
+        woe_id=-99.0,
+        adm0_a3_is="ITA",
+        adm0_a3_us="ITA",
+        adm0_a3_un=-99.0,
+        adm0_a3_wb=-99.0,
+        continent="Europe",
+        region_un="Europe",
+        subregion="Southern Europe",
+        region_wb="Europe & Central Asia",
+        name_len=15.0,
+        long_len=15.0,
+        abbrev_len=4.0,
+        tiny=-99.0,
+        homepart=-99.0),
+    Country(
+        bbox=(176.7, -12.7, 180.0, -5.4),
+        scalerank=1,
+        featurecla="Admin-0 map subunit",
+        labelrank=6.0,
+        sovereignt="Tuvalu",
+        sov_a3="TUV",
+        adm0_dif=0.0,
+        level=2.0,
+        type="Sovereign country",
+        admin="Tuvalu",
+        adm0_a3="TUV",
+        geou_dif=0.0,
+        geounit="Tuvalu",
+        gu_a3="TUV",
+        su_dif=0.0,
+        subunit="Tuvalu",
+        su_a3="TUV",
+        brk_diff=0.0,
+        name="Tuvalu",
+        name_long="Tuvalu",
+        brk_a3="TUV",
+        brk_name="Tuvalu",
+        brk_group="",
+        abbrev="Tuvalu",
+        postal="TV",
+        formal_en="Tuvalu",
+        formal_fr="",
+        note_adm0="",
+        note_brk="",
+        name_sort="Tuvalu",
+        name_alt="",
+        mapcolor7=5.0,
+        mapcolor8=7.0,
+        mapcolor9=6.0,
+        mapcolor13=12.0,
+        pop_est=10837.0,
+        gdp_md_est=3400.0,
+        pop_year=-99.0,
+        lastcensus=2012.0,
+        gdp_year=-99.0,
+        economy="7. Least developed region",
+        income_grp="4. Lower middle income",
+        wikipedia=-99.0,
+        fips_10="",
+        iso_a2="TV",
+        iso_a3="TUV",
+        iso_n3="789",
+        un_a3="789",
+        wb_a2="TV",
+        wb_a3="TUV",
+        woe_id=-99.0,
+        adm0_a3_is="TUV",
+        adm0_a3_us="TUV",
+        adm0_a3_un=-99.0,
+        adm0_a3_wb=-99.0,
+        continent="Oceania",
+        region_un="Oceania",
+        subregion="Micronesia",
+        region_wb="East Asia & Pacific",
+        name_len=6.0,
+        long_len=6.0,
+        abbrev_len=6.0,
+        tiny=2.0,
+        homepart=1.0),
+    Country(
+        bbox=(176.7, -12.7, 180.0, -5.4),
+        scalerank=1,
+        featurecla="Admin-0 map subunit",
+        labelrank=6.0,
+        sovereignt="Tuvalu",
+        sov_a3="TUV",
+        adm0_dif=0.0,
+        level=2.0,
+        type="Sovereign country",
+        admin="Tuvalu",
+        adm0_a3="TUV",
+        geou_dif=0.0,
+        geounit="Tuvalu",
+        gu_a3="TUV",
+        su_dif=0.0,
+        subunit="Tuvalu",
+        su_a3="TUV",
+        brk_diff=0.0,
+        name="Tuvalu",
+        name_long="Tuvalu",
+        brk_a3="TUV",
+        brk_name="Tuvalu",
+        brk_group="",
+        abbrev="Tuvalu",
+        postal="TV",
+        formal_en="Tuvalu",
+        formal_fr="",
+        note_adm0="",
+        note_brk="",
+        name_sort="Tuvalu",
+        name_alt="",
+        mapcolor7=5.0,
+        mapcolor8=7.0,
+        mapcolor9=6.0,
+        mapcolor13=12.0,
+        pop_est=10837.0,
+        gdp_md_est=3400.0,
+        pop_year=-99.0,
+        lastcensus=2012.0,
+        gdp_year=-99.0,
+        economy="7. Least developed region",
+        income_grp="4. Lower middle income",
+        wikipedia=-99.0,
+        fips_10="",
+        iso_a2="TV",
+        iso_a3="TUV",
+        iso_n3="789",
+        un_a3="789",
+        wb_a2="TV",
+        wb_a3="TUV",
+        woe_id=-99.0,
+        adm0_a3_is="TUV",
+        adm0_a3_us="TUV",
+        adm0_a3_un=-99.0,
+        adm0_a3_wb=-99.0,
+        continent="Oceania",
+        region_un="Oceania",
+        subregion="Micronesia",
+        region_wb="East Asia & Pacific",
+        name_len=6.0,
+        long_len=6.0,
+        abbrev_len=6.0,
+        tiny=2.0,
+        homepart=1.0),
+    Country(
+        bbox=(-5.368, 36.108618, -5.336, 36.155),
+        scalerank=3,
+        featurecla="Admin-0 map subunit",
+        labelrank=6.0,
+        sovereignt="United Kingdom",
+        sov_a3="GB1",
+        adm0_dif=1.0,
+        level=2.0,
+        type="Dependency",
+        admin="Gibraltar",
+        adm0_a3="GIB",
+        geou_dif=0.0,
+        geounit="Gibraltar",
+        gu_a3="GIB",
+        su_dif=0.0,
+        subunit="Gibraltar",
+        su_a3="GIB",
+        brk_diff=0.0,
+        name="Gibraltar",
+        name_long="Gibraltar",
+        brk_a3="GIB",
+        brk_name="Gibraltar",
+        brk_group="",
+        abbrev="Gibraltar",
+        postal="GI",
+        formal_en="Gibraltar",
+        formal_fr="",
+        note_adm0="U.K.",
+        note_brk="",
+        name_sort="Gibraltar",
+        name_alt="",
+        mapcolor7=6.0,
+        mapcolor8=6.0,
+        mapcolor9=6.0,
+        mapcolor13=3.0,
+        pop_est=30001,
+        gdp_md_est=45834,
+        pop_year=-99.0,
+        lastcensus=-99.0,
+        gdp_year=-99.0,
+        economy="2. Developed region: nonG7",
+        income_grp="1. High income: OECD",
+        wikipedia=-99.0,
+        fips_10="",
+        iso_a2="GI",
+        iso_a3="GIB",
+        iso_n3="292",
+        un_a3="292",
+        wb_a2="-99",
+        wb_a3="-99",
+        woe_id=-99.0,
+        adm0_a3_is="GIB",
+        adm0_a3_us="GIB",
+        adm0_a3_un=-99.0,
+        adm0_a3_wb=-99.0,
+        continent="Europe",
+        region_un="Europe",
+        subregion="Southern Europe",
+        region_wb="Europe & Central Asia",
+        name_len=9.0,
+        long_len=9.0,
+        abbrev_len=9.0,
+        tiny=3.0,
+        homepart=-99.0),
 ]
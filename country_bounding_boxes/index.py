@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Spatial indexes over the (lon1, lat1, lon2, lat2) bounding boxes of the
+# country subunits. The indexes only ever deal in positions within the
+# sequence of boxes they were built from; mapping those back to Country
+# records is left to the caller.
+
+import heapq
+import math
+
+# Mean radius of the earth, in km.
+EARTH_RADIUS_KM = 6371.0088
+
+
+def box_contains_point(bbox, lon, lat):
+    (lon1, lat1, lon2, lat2) = bbox
+    return lon1 <= lon and lon <= lon2 and lat1 <= lat and lat <= lat2
+
+
+def box_intersects_box(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _wrap(dlon):
+    # A longitude difference, in degrees, folded into [-180, 180].
+    return (dlon + 180.0) % 360.0 - 180.0
+
+
+def _central_angle(lon1, lat1, lon2, lat2):
+    # Haversine formula; arguments in radians.
+    h = (math.sin((lat2 - lat1) / 2.0) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2.0) ** 2)
+    return 2.0 * math.asin(min(1.0, math.sqrt(h)))
+
+
+def _meridian_angle(lon, lat, m, lat1, lat2):
+    # Central angle from a point to the stretch of meridian m between lat1
+    # and lat2; all in radians. The nearest point of the whole meridian is
+    # at the foot of the perpendicular, when that lies on the near side of
+    # the globe; failing that, it is one of the stretch's ends.
+    dlon = math.radians(_wrap(math.degrees(lon - m)))
+    if abs(dlon) < math.pi / 2.0:
+        foot = math.atan(math.tan(lat) / math.cos(dlon))
+        if lat1 <= foot <= lat2:
+            return math.asin(min(1.0, abs(math.sin(dlon)) * math.cos(lat)))
+    return min(_central_angle(lon, lat, m, lat1),
+               _central_angle(lon, lat, m, lat2))
+
+
+def box_area_km2(bbox):
+    """
+    Area in km^2 of the patch of the earth's surface bounded by a (lon1,
+    lat1, lon2, lat2) box. A box with lon1 greater than lon2 is taken to
+    cross the international date line.
+    """
+    (lon1, lat1, lon2, lat2) = bbox[:4]
+    width = lon2 - lon1
+    if width < 0:
+        width += 360.0
+    return (EARTH_RADIUS_KM ** 2 * math.radians(width) *
+            (math.sin(math.radians(lat2)) - math.sin(math.radians(lat1))))
+
+
+def box_distance_km(bbox, lon, lat):
+    """
+    Great-circle distance in km from a point to the nearest point of a
+    (lon1, lat1, lon2, lat2) box; 0 for points inside it.
+    """
+    (lon1, lat1, lon2, lat2) = bbox[:4]
+    if lon1 <= lon <= lon2:
+        # Straight north or south, or not at all.
+        if lat < lat1:
+            return EARTH_RADIUS_KM * math.radians(lat1 - lat)
+        if lat > lat2:
+            return EARTH_RADIUS_KM * math.radians(lat - lat2)
+        return 0.0
+    # Otherwise the nearest point is on one of the two meridian edges,
+    # since along a parallel distance only grows away from the point.
+    (x, y) = (math.radians(lon), math.radians(lat))
+    (y1, y2) = (math.radians(lat1), math.radians(lat2))
+    return EARTH_RADIUS_KM * min(
+        _meridian_angle(x, y, math.radians(lon1), y1, y2),
+        _meridian_angle(x, y, math.radians(lon2), y1, y2))
+
+
+def box_distance_degrees(bbox, lon, lat):
+    """
+    Planar distance in degrees from a point to a (lon1, lat1, lon2, lat2)
+    box, treating lon/lat as flat x/y that wraps at the date line; 0 for
+    points inside it.
+    """
+    (lon1, lat1, lon2, lat2) = bbox[:4]
+    if lon1 <= lon <= lon2:
+        dx = 0.0
+    else:
+        dx = min(abs(_wrap(lon - lon1)), abs(_wrap(lon - lon2)))
+    dy = max(lat1 - lat, 0.0, lat - lat2)
+    return math.hypot(dx, dy)
+
+
+# Every cell of a QuadkeyIndex is a reference (k << 2) | tag, where the tag
+# says what k indexes.
+RESOLVED = 0    # list k is the answer for every point in the cell
+REFINE = 1      # list k holds the boxes left to test
+SPLIT = 2       # splits[4 * k:4 * k + 4] are the cell's four quadrants
+
+
+class QuadkeyIndex(object):
+    """
+    A quadtree over the lon/lat plane, precomputed from the boxes by
+    build(). Every leaf is labelled either as resolved, meaning each point
+    in it lies in exactly the same boxes (so the answer is stored
+    outright), or as needing refinement, in which case it holds the few
+    boxes still to test. The tree is flattened into an array of the cells
+    at top_depth, so that a point deep inside a country or out at sea is
+    answered with a single probe and no comparisons at all. Results are
+    exactly those of a linear scan, in the same order.
+
+    cells holds a reference per top-level cell, row-major from the south
+    west; splits holds four references per subdivided cell, in quadkey
+    order (south-west, south-east, north-west, north-east). List k is
+    list_items[list_offsets[k]:list_offsets[k + 1]], a run of positions.
+    """
+
+    # Cells are widened by this much (in degrees) when deciding whether
+    # they resolve, so that rounding in working out a point's cell can
+    # never put it just outside a box the cell claims to be inside.
+    margin = 1e-9
+
+    def __init__(self, bboxes, top_depth, max_depth, cells, splits,
+                 list_offsets, list_items):
+        if not 0 <= top_depth <= max_depth:
+            raise ValueError("need 0 <= top_depth <= max_depth")
+        self.bboxes = tuple(bboxes)
+        self.top_depth = top_depth
+        self.max_depth = max_depth
+        self.cells = cells
+        self.splits = splits
+        self.list_offsets = list_offsets
+        self.list_items = list_items
+        self._xscale = (1 << max_depth) / 360.0
+        self._yscale = (1 << max_depth) / 180.0
+        self._last = (1 << max_depth) - 1
+
+    @classmethod
+    def build(cls, bboxes, top_depth=7, max_depth=10):
+        """
+        Rasterize the boxes into a new index, subdividing each cell that
+        does not resolve until max_depth.
+        """
+        if not 0 <= top_depth <= max_depth:
+            raise ValueError("need 0 <= top_depth <= max_depth")
+        bboxes = tuple(bboxes)
+        side = 1 << top_depth
+        cells = [None] * (side * side)
+        splits = []
+        list_offsets = [0]
+        list_items = []
+        list_ids = {}
+
+        def label(depth, x, y, candidates):
+            # The boxes overlapping cell (x, y) at depth, and whether
+            # every one of them covers it.
+            n = float(1 << depth)
+            m = cls.margin
+            lon1 = max(x * 360.0 / n - 180.0 - m, -180.0)
+            lon2 = min((x + 1) * 360.0 / n - 180.0 + m, 180.0)
+            lat1 = max(y * 180.0 / n - 90.0 - m, -90.0)
+            lat2 = min((y + 1) * 180.0 / n - 90.0 + m, 90.0)
+            overlapping = []
+            resolved = True
+            for i in candidates:
+                b = bboxes[i]
+                if b[0] <= lon2 and lon1 <= b[2] and b[1] <= lat2 and \
+                   lat1 <= b[3]:
+                    overlapping.append(i)
+                    if resolved and not (b[0] <= lon1 and lon2 <= b[2] and
+                                         b[1] <= lat1 and lat2 <= b[3]):
+                        resolved = False
+            return (overlapping, resolved)
+
+        def leaf(positions, tag):
+            # Equal lists (the empty answer above all) are stored once.
+            key = (tuple(positions), tag)
+            if key not in list_ids:
+                list_ids[key] = len(list_offsets) - 1
+                list_items.extend(key[0])
+                list_offsets.append(len(list_items))
+            return (list_ids[key] << 2) | tag
+
+        def subtree(depth, x, y, overlapping, resolved):
+            if resolved:
+                return leaf(overlapping, RESOLVED)
+            if depth == max_depth:
+                return leaf(overlapping, REFINE)
+            children = []
+            for q in range(4):
+                (cx, cy) = (2 * x + (q & 1), 2 * y + (q >> 1))
+                (o, r) = label(depth + 1, cx, cy, overlapping)
+                children.append(subtree(depth + 1, cx, cy, o, r))
+            if children[0] & 3 != SPLIT and children.count(children[0]) == 4:
+                # Four identical leaves are no better than one.
+                return children[0]
+            splits.extend(children)
+            return ((len(splits) // 4 - 1) << 2) | SPLIT
+
+        # Above top_depth a cell that resolves fills every top-level cell
+        # under it; the rest are subdivided into their own subtrees.
+        stack = [(0, 0, 0, range(len(bboxes)))]
+        while stack:
+            (depth, x, y, candidates) = stack.pop()
+            (overlapping, resolved) = label(depth, x, y, candidates)
+            if depth == top_depth:
+                cells[y * side + x] = subtree(depth, x, y, overlapping,
+                                              resolved)
+            elif resolved:
+                ref = leaf(overlapping, RESOLVED)
+                span = 1 << (top_depth - depth)
+                for r in range(y * span, (y + 1) * span):
+                    cells[r * side + x * span:
+                          r * side + (x + 1) * span] = [ref] * span
+            else:
+                for q in range(4):
+                    stack.append((depth + 1, 2 * x + (q & 1),
+                                  2 * y + (q >> 1), overlapping))
+        return cls(bboxes, top_depth, max_depth, cells, splits,
+                   list_offsets, list_items)
+
+    def query_point(self, lon, lat):
+        """
+        Return the positions of the boxes containing the point.
+        """
+        if not (-180.0 <= lon <= 180.0 and -90.0 <= lat <= 90.0):
+            # Off the map (or NaN): fall back to testing every box.
+            return [i for (i, b) in enumerate(self.bboxes)
+                    if box_contains_point(b, lon, lat)]
+        # Cell coordinates at max_depth; points on the far edge of the
+        # world belong to the last column or row.
+        x = min(int((lon + 180.0) * self._xscale), self._last)
+        y = min(int((lat + 90.0) * self._yscale), self._last)
+        shift = self.max_depth - self.top_depth
+        ref = self.cells[((y >> shift) << self.top_depth) + (x >> shift)]
+        while True:
+            tag = ref & 3
+            if tag != SPLIT:
+                k = ref >> 2
+                positions = self.list_items[self.list_offsets[k]:
+                                            self.list_offsets[k + 1]]
+                if tag == RESOLVED:
+                    return list(positions)
+                bboxes = self.bboxes
+                res = []
+                for i in positions:
+                    b = bboxes[i]
+                    if b[0] <= lon and lon <= b[2] and b[1] <= lat and \
+                       lat <= b[3]:
+                        res.append(i)
+                return res
+            shift -= 1
+            ref = self.splits[(ref & ~3) | ((y >> shift) & 1) << 1 |
+                              ((x >> shift) & 1)]
+
+    def query_points(self, points):
+        """
+        Return, for each (lon, lat) of points, the positions of the boxes
+        containing it, as query_point would. The whole batch is probed in
+        one loop, without query_point's per-call overhead.
+        """
+        cells = self.cells
+        splits = self.splits
+        list_offsets = self.list_offsets
+        list_items = self.list_items
+        bboxes = self.bboxes
+        (xscale, yscale, last) = (self._xscale, self._yscale, self._last)
+        top_depth = self.top_depth
+        depth = self.max_depth - top_depth
+        res = []
+        append = res.append
+        for (lon, lat) in points:
+            if not (-180.0 <= lon <= 180.0 and -90.0 <= lat <= 90.0):
+                append(self.query_point(lon, lat))
+                continue
+            x = int((lon + 180.0) * xscale)
+            y = int((lat + 90.0) * yscale)
+            if x > last:
+                x = last
+            if y > last:
+                y = last
+            shift = depth
+            ref = cells[((y >> shift) << top_depth) + (x >> shift)]
+            while ref & 3 == SPLIT:
+                shift -= 1
+                ref = splits[(ref & ~3) | ((y >> shift) & 1) << 1 |
+                             ((x >> shift) & 1)]
+            k = ref >> 2
+            positions = list_items[list_offsets[k]:list_offsets[k + 1]]
+            if ref & 3 == RESOLVED:
+                append(list(positions))
+            else:
+                append([i for i in positions
+                        if bboxes[i][0] <= lon and lon <= bboxes[i][2] and
+                        bboxes[i][1] <= lat and lat <= bboxes[i][3]])
+        return res
+
+    def resolved_fraction(self):
+        """
+        Return the fraction of the map (by lon/lat area) covered by
+        resolved cells.
+        """
+        total = 0.0
+        stack = [(ref, 1.0 / len(self.cells)) for ref in self.cells]
+        while stack:
+            (ref, area) = stack.pop()
+            if ref & 3 == RESOLVED:
+                total += area
+            elif ref & 3 == SPLIT:
+                k = ref & ~3
+                stack.extend((self.splits[k + q], area / 4)
+                             for q in range(4))
+        return total
+
+
+def _union(bboxes):
+    return (min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+
+def _sort_tile(entries, capacity):
+    # Sort-Tile-Recursive: sort by x-center, cut into vertical slices of
+    # sqrt(pages) pages each, sort each slice by y-center and cut it into
+    # full pages. Entries are (bbox, payload) pairs.
+    pages = int(math.ceil(len(entries) / float(capacity)))
+    per_slice = max(int(math.ceil(math.sqrt(pages))), 1) * capacity
+    entries = sorted(entries, key=lambda e: e[0][0] + e[0][2])
+    groups = []
+    for s in range(0, len(entries), per_slice):
+        piece = sorted(entries[s:s + per_slice],
+                       key=lambda e: e[0][1] + e[0][3])
+        for p in range(0, len(piece), capacity):
+            groups.append(piece[p:p + capacity])
+    return groups
+
+
+class STRTree(object):
+    """
+    An immutable R-tree bulk-loaded with the Sort-Tile-Recursive
+    algorithm. Since the set of boxes never changes, every node except the
+    last on each level is completely full.
+
+    Nodes are numbered root first and stored as two flat arrays: boxes
+    holds the (lon1, lat1, lon2, lat2) of node k at boxes[4 * k:4 * k + 4]
+    and links its (start, end) at links[2 * k:2 * k + 2]. Nodes at or past
+    leaf_start cover items[start:end], the rest cover nodes start to end.
+    """
+
+    def __init__(self, bboxes, capacity=8):
+        self.bboxes = tuple(bboxes)
+        self.capacity = capacity
+
+        groups = _sort_tile([(b, i) for (i, b) in enumerate(self.bboxes)],
+                            capacity)
+        items = []
+        level = []
+        for g in groups:
+            level.append(_union([b for (b, _) in g]) +
+                         (len(items), len(items) + len(g)))
+            items.extend(i for (_, i) in g)
+        self.items = tuple(items)
+
+        # Build upwards until a single root remains. Child ranges are
+        # relative to the level below until we flatten.
+        levels = [level]
+        while len(level) > 1:
+            groups = _sort_tile([(n[:4], n) for n in level], capacity)
+            below = []
+            level = []
+            for g in groups:
+                level.append(_union([b for (b, _) in g]) +
+                             (len(below), len(below) + len(g)))
+                below.extend(n for (_, n) in g)
+            levels[-1] = below
+            levels.append(level)
+
+        # Flatten root first, rebasing child ranges to absolute offsets.
+        levels.reverse()
+        boxes = []
+        links = []
+        for (depth, level) in enumerate(levels):
+            base = len(links) // 2 + len(level)
+            if depth == len(levels) - 1:
+                base = 0
+            for n in level:
+                boxes.extend(n[:4])
+                links.extend((n[4] + base, n[5] + base))
+        self.boxes = tuple(boxes)
+        self.links = tuple(links)
+        self.leaf_start = len(links) // 2 - len(levels[-1]) if links else 0
+
+    @classmethod
+    def from_arrays(cls, bboxes, capacity, leaf_start, boxes, links, items):
+        """
+        Recreate a tree from the arrays of one built earlier (as stored in
+        the country data file), without repeating the work.
+        """
+        tree = cls.__new__(cls)
+        tree.bboxes = tuple(bboxes)
+        tree.capacity = capacity
+        tree.leaf_start = leaf_start
+        tree.boxes = boxes
+        tree.links = links
+        tree.items = items
+        return tree
+
+    @property
+    def nodes(self):
+        """
+        The nodes as (lon1, lat1, lon2, lat2, start, end) tuples.
+        """
+        (boxes, links) = (self.boxes, self.links)
+        return [tuple(boxes[4 * k:4 * k + 4]) + tuple(links[2 * k:2 * k + 2])
+                for k in range(len(links) // 2)]
+
+    def _node_box(self, k):
+        return tuple(self.boxes[4 * k:4 * k + 4])
+
+    def query_bbox(self, bbox):
+        """
+        Return the positions of the boxes intersecting the (lon1, lat1,
+        lon2, lat2) box, edges included, in ascending order.
+        """
+        if not self.links:
+            return []
+        (x1, y1, x2, y2) = bbox
+        boxes = self.boxes
+        links = self.links
+        items = self.items
+        bboxes = self.bboxes
+        leaf_start = self.leaf_start
+        res = []
+        stack = [0]
+        while stack:
+            k = stack.pop()
+            b = 4 * k
+            if boxes[b] > x2 or x1 > boxes[b + 2] or \
+               boxes[b + 1] > y2 or y1 > boxes[b + 3]:
+                continue
+            if k < leaf_start:
+                stack.extend(range(links[2 * k], links[2 * k + 1]))
+                continue
+            for j in range(links[2 * k], links[2 * k + 1]):
+                i = items[j]
+                b = bboxes[i]
+                if b[0] <= x2 and x1 <= b[2] and b[1] <= y2 and y1 <= b[3]:
+                    res.append(i)
+        res.sort()
+        return res
+
+    def query_point(self, lon, lat):
+        """
+        Return the positions of the boxes containing the point, in
+        ascending order.
+        """
+        # A box contains a point exactly when it intersects the
+        # degenerate box at that point.
+        return self.query_bbox((lon, lat, lon, lat))
+
+    def query_distance(self, lon, lat, max_distance,
+                       distance=box_distance_km):
+        """
+        Return the positions of the boxes within max_distance of the point,
+        in ascending order. distance is as for nearest().
+        """
+        if not self.links:
+            return []
+        links = self.links
+        items = self.items
+        bboxes = self.bboxes
+        leaf_start = self.leaf_start
+        node_box = self._node_box
+        res = []
+        stack = [0]
+        while stack:
+            k = stack.pop()
+            if distance(node_box(k), lon, lat) > max_distance:
+                continue
+            if k < leaf_start:
+                stack.extend(range(links[2 * k], links[2 * k + 1]))
+                continue
+            for j in range(links[2 * k], links[2 * k + 1]):
+                i = items[j]
+                if distance(bboxes[i], lon, lat) <= max_distance:
+                    res.append(i)
+        res.sort()
+        return res
+
+    def nearest(self, lon, lat, k=1, max_distance=None,
+                distance=box_distance_km):
+        """
+        Return up to k (distance, position) pairs for the boxes nearest the
+        point, nearest first (ties in ascending position), leaving out any
+        further than max_distance. distance(bbox, lon, lat) measures from
+        the point to a box; boxes containing the point are at distance 0.
+        """
+        if not self.links or k < 1:
+            return []
+        links = self.links
+        items = self.items
+        bboxes = self.bboxes
+        leaf_start = self.leaf_start
+        node_box = self._node_box
+        res = []
+
+        # Best-first search: the heap holds nodes and boxes keyed by their
+        # distance, which for a node bounds that of everything inside it.
+        # At equal distances nodes sort before boxes, so every box at that
+        # distance is queued before the first of them is reported.
+        heap = [(distance(node_box(0), lon, lat), 0, 0)]
+        while heap:
+            (d, is_box, k_or_i) = heapq.heappop(heap)
+            if max_distance is not None and d > max_distance:
+                break
+            if is_box:
+                res.append((d, k_or_i))
+                if len(res) == k:
+                    break
+                continue
+            (start, end) = (links[2 * k_or_i], links[2 * k_or_i + 1])
+            if k_or_i < leaf_start:
+                for c in range(start, end):
+                    heapq.heappush(heap, (distance(node_box(c), lon, lat),
+                                          0, c))
+            else:
+                for j in range(start, end):
+                    i = items[j]
+                    heapq.heappush(heap, (distance(bboxes[i], lon, lat), 1, i))
+        return res
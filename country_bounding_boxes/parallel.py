@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Point lookups spread over a pool of worker processes, for inputs large
+# enough that a single core is the bottleneck. Where the platform can fork,
+# the data and indexes are loaded and built in the parent before the pool
+# starts, so every worker shares them copy-on-write rather than having
+# them pickled over or rebuilt; only the points and the answers (as row
+# positions) cross between processes. Elsewhere each worker loads its own
+# copy on start.
+
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+from country_bounding_boxes import _point_query, _polygons, _preload, \
+    _specificity_ranks, countries
+
+# Points handed to a worker at a time; large enough that the cost of
+# shipping a batch over is small next to looking it up.
+DEFAULT_CHUNK_SIZE = 4096
+
+# Batches queued per worker process, bounding how far reading the input
+# runs ahead of the results.
+BACKLOG = 2
+
+
+def _batches(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _pool(processes, initializer=None, initargs=()):
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is not None and \
+       'fork' in multiprocessing.get_all_start_methods():
+        return get_context('fork').Pool(processes, initializer, initargs)
+    return multiprocessing.Pool(processes, initializer, initargs)
+
+
+def ordered_map(func, batches, processes=None, initializer=None,
+                initargs=()):
+    """
+    Iterate over func(batch) for each of batches, computed in a pool of
+    processes (by default, one per CPU) but yielded in input order. Only
+    a few batches per process are read ahead, so the input can be an
+    arbitrarily long iterator. func must be a module-level function.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 1:
+        raise ValueError("processes must be positive")
+    return _ordered_map(func, batches, processes, initializer, initargs)
+
+
+def _ordered_map(func, batches, processes, initializer, initargs):
+    pool = _pool(processes, initializer, initargs)
+    try:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(func, (batch, )))
+            if len(pending) >= BACKLOG * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+def _lookup_batch(args):
+    (points, precise, resolution, smallest_first) = args
+    res = []
+    for (lon, lat) in points:
+        hits = _point_query(lon, lat, precise, resolution)
+        if smallest_first:
+            hits.sort(key=_specificity_ranks().__getitem__)
+        res.append(hits)
+    return res
+
+
+def country_subunits_containing_points(points, processes=None,
+                                       chunk_size=DEFAULT_CHUNK_SIZE,
+                                       precise=False,
+                                       resolution=_polygons.DEFAULT_LEVEL,
+                                       smallest_first=False):
+    """
+    Look up many (lon, lat) points in parallel. Iterates over one list per
+    point, in the order of points, of the country subunits that
+    country_subunits_containing_point would return for it with the same
+    precise, resolution and smallest_first arguments. Points are shared
+    out chunk_size at a time among processes worker processes (by
+    default, one per CPU).
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    # Build everything the workers need now, so that forked workers
+    # inherit it.
+    _preload(precise, resolution)
+    work = ((batch, precise, resolution, smallest_first)
+            for batch in _batches(points, chunk_size))
+    results = ordered_map(_lookup_batch, work, processes)
+    return ([countries[i] for i in hits] for res in results for hits in res)
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# A small JSON-over-HTTP lookup service, using nothing beyond the standard
+# library:
+#
+#     $ python -m country_bounding_boxes.server --port 8080
+#     $ curl 'localhost:8080/point?lon=-79.888252&lat=32.819747'
+#
+# Every index is loaded before the server starts taking requests and is
+# shared, read-only, by the threads that serve them. Connections are kept
+# alive between requests (HTTP/1.1), and POST /points answers thousands of
+# points in one request and one pass over the index, with each subunit's
+# JSON encoded once up front rather than for every point it turns up in.
+#
+#     GET  /point?lon=&lat=     subunits containing a point
+#     POST /points              the same for {"points": [[lon, lat], ...]}
+#     GET  /bbox?lon1=&lat1=&lon2=&lat2=
+#                               subunits intersecting (or, with within=1,
+#                               inside) a box
+#     GET  /iso/<code>          subunits by ISO alpha2 or alpha3 code
+#     GET  /metrics             request counts and latencies per endpoint
+#
+# Point lookups take precise, resolution and smallest_first as for
+# country_subunits_containing_point, and every lookup takes fields, a
+# comma-separated list of the subunit fields to return (by default, all).
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlsplit
+else:
+    from urllib import unquote
+
+from country_bounding_boxes import (
+    _ensure_caches_populated,
+    _point_query,
+    _points_query,
+    _polygon_outlines,
+    _polygons,
+    _preload,
+    _rtree_index,
+    _specificity_ranks,
+    Country,
+    countries,
+    country_subunits_by_iso_code,
+    country_subunits_intersecting_bbox,
+    country_subunits_within_bbox,
+)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+
+# Limits on a POST /points request, past which it is refused outright.
+MAX_BODY_BYTES = 16 * 1024 * 1024
+MAX_BATCH_POINTS = 100000
+
+# Upper bounds (in milliseconds) of the latency histogram buckets kept for
+# each endpoint; slower requests fall in a last, unbounded bucket.
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250,
+                      500, 1000)
+
+# Latencies are timed with the highest-resolution clock to hand, which
+# (unlike the wall clock) does not jump when the system time is set.
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Sets of fields whose encoded subunits are kept; requests for any others
+# are encoded as they come.
+MAX_FIELD_SETS = 32
+
+_TRUE = ('1', 'true', 'yes', 'on')
+
+
+class HTTPError(Exception):
+    """
+    A request that cannot be answered, with the status to answer it with.
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Metrics(object):
+    """
+    Per-endpoint request counts and latencies, safe to update from many
+    threads. snapshot() returns them as a dict of plain values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, seconds, error=False, points=0):
+        ms = seconds * 1000.0
+        with self._lock:
+            m = self._endpoints.get(endpoint)
+            if m is None:
+                m = self._endpoints[endpoint] = {
+                    'requests': 0, 'errors': 0, 'points': 0,
+                    'total_ms': 0.0, 'max_ms': 0.0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                }
+            m['requests'] += 1
+            m['errors'] += bool(error)
+            m['points'] += points
+            m['total_ms'] += ms
+            m['max_ms'] = max(m['max_ms'], ms)
+            k = 0
+            while k < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[k]:
+                k += 1
+            m['buckets'][k] += 1
+
+    def snapshot(self):
+        with self._lock:
+            res = {}
+            for (endpoint, m) in self._endpoints.items():
+                m = dict(m)
+                m['mean_ms'] = m['total_ms'] / m['requests']
+                m['buckets'] = [
+                    {'le_ms': le, 'requests': n} for (le, n) in
+                    zip(LATENCY_BUCKETS_MS + (None, ), m['buckets'])]
+                res[endpoint] = m
+            return res
+
+
+class SubunitEncoder(object):
+    """
+    The JSON of each subunit, with all its fields or a chosen few, encoded
+    once and then reused.
+    """
+
+    def __init__(self):
+        self._encoded = {}
+
+    def fragments(self, fields=None):
+        """
+        Return a list, by position in all_country_subunits(), of the JSON
+        text of each subunit restricted to fields (a tuple of field names,
+        or None for all of them).
+        """
+        frags = self._encoded.get(fields)
+        if frags is None:
+            if fields is not None:
+                for f in fields:
+                    if f not in Country._fields:
+                        raise HTTPError(400, "unknown field %r" % (f, ))
+            frags = [self._encode(c, fields or Country._fields)
+                     for c in countries]
+            if len(self._encoded) < MAX_FIELD_SETS:
+                self._encoded[fields] = frags
+        return frags
+
+    def _encode(self, c, fields):
+        obj = dict((f, getattr(c, f)) for f in fields)
+        if 'bbox' in obj:
+            obj['bbox'] = list(obj['bbox'])
+        return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+class LookupServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server answering lookups on a thread per connection. Creating
+    it loads every index the lookups use (and, for each of preload_levels,
+    the subunit outlines at that resolution), so that no request pays for
+    it and the threads share one copy.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, preload_levels=(), access_log=False):
+        _preload()
+        _rtree_index()
+        _ensure_caches_populated()
+        for level in preload_levels:
+            _polygon_outlines(level)
+        self.encoder = SubunitEncoder()
+        self.encoder.fragments()
+        self.metrics = Metrics()
+        self.access_log = access_log
+        HTTPServer.__init__(self, address, LookupHandler)
+
+
+def _flag(value):
+    return value is not None and str(value).lower() in _TRUE
+
+
+def _number(params, name):
+    try:
+        x = float(params[name])
+    except KeyError:
+        raise HTTPError(400, "missing parameter %r" % (name, ))
+    except (TypeError, ValueError):
+        raise HTTPError(400, "parameter %r is not a number" % (name, ))
+    if x != x:
+        raise HTTPError(400, "parameter %r is not a number" % (name, ))
+    return x
+
+
+def _fields(value):
+    if value is None:
+        return None
+    if not isinstance(value, (list, tuple)):
+        value = str(value).split(',')
+    return tuple(str(f).strip() for f in value if str(f).strip()) or None
+
+
+def _lookup_options(params):
+    precise = _flag(params.get('precise'))
+    resolution = params.get('resolution', _polygons.DEFAULT_LEVEL)
+    if resolution not in _polygons.LEVELS:
+        raise HTTPError(400, "unknown resolution %r" % (resolution, ))
+    if precise:
+        try:
+            _polygon_outlines(resolution)
+        except (IOError, OSError, ValueError) as e:
+            raise HTTPError(503, "outlines unavailable: %s" % (e, ))
+    return (precise, resolution, _flag(params.get('smallest_first')))
+
+
+def _json_list(frags, hits):
+    return '[' + ','.join([frags[i] for i in hits]) + ']'
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'country-bounding-boxes'
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        start = _clock()
+        url = urlsplit(self.path)
+        params = dict((k, v[-1]) for (k, v) in parse_qs(url.query).items())
+        parts = url.path.strip('/').split('/')
+        endpoint = parts[0]
+        points = 0
+        try:
+            if method == 'POST':
+                if endpoint != 'points':
+                    # Its body is left unread, as with _read_json. Like
+                    # unknown paths, it is counted under 'other', so that
+                    # clients cannot add endpoints to the metrics.
+                    endpoint = 'other'
+                    self.close_connection = True
+                    raise HTTPError(405, "POST is only for /points")
+                (points, body) = self._points(self._read_json())
+            elif endpoint == 'point' and len(parts) == 1:
+                (points, body) = (1, self._point(params))
+            elif endpoint == 'bbox' and len(parts) == 1:
+                body = self._bbox(params)
+            elif endpoint == 'iso' and len(parts) == 2:
+                body = self._iso(unquote(parts[1]), params)
+            elif endpoint == 'metrics' and len(parts) == 1:
+                body = json.dumps(self.server.metrics.snapshot(),
+                                  sort_keys=True)
+            else:
+                endpoint = 'other'
+                raise HTTPError(404, "no such endpoint")
+            status = 200
+        except HTTPError as e:
+            (status, body) = (e.status, json.dumps({'error': str(e)}))
+        except Exception as e:
+            (status, body) = (500, json.dumps({'error': str(e)}))
+        self._respond(status, body)
+        self.server.metrics.record(endpoint, _clock() - start,
+                                   status != 200, points)
+
+    def _respond(self, status, body):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.close_connection = True
+            raise HTTPError(411, "a Content-Length is required")
+        if length < 0:
+            # Reading to the end of the stream would block until the
+            # client hangs up.
+            self.close_connection = True
+            raise HTTPError(400, "negative Content-Length")
+        if length > MAX_BODY_BYTES:
+            # The body is left unread, so the connection cannot be reused.
+            self.close_connection = True
+            raise HTTPError(413, "request body too large")
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            raise HTTPError(400, "request body is not valid JSON")
+
+    def _point(self, params):
+        (precise, resolution, smallest_first) = _lookup_options(params)
+        frags = self.server.encoder.fragments(_fields(params.get('fields')))
+        hits = _point_query(_number(params, 'lon'), _number(params, 'lat'),
+                            precise, resolution)
+        if smallest_first:
+            hits.sort(key=_specificity_ranks().__getitem__)
+        return '{"subunits":' + _json_list(frags, hits) + '}'
+
+    def _points(self, req):
+        if not isinstance(req, dict) or \
+           not isinstance(req.get('points'), list):
+            raise HTTPError(400, "expected an object with a points list")
+        points = req['points']
+        if len(points) > MAX_BATCH_POINTS:
+            raise HTTPError(413, "more than %d points" % MAX_BATCH_POINTS)
+        (precise, resolution, smallest_first) = _lookup_options(req)
+        frags = self.server.encoder.fragments(_fields(req.get('fields')))
+        # Every point is checked before any is looked up, and then all
+        # of them are looked up in one pass over the index.
+        pts = []
+        for (k, p) in enumerate(points):
+            try:
+                if not isinstance(p, (list, tuple)) or len(p) != 2:
+                    raise ValueError
+                (lon, lat) = (float(p[0]), float(p[1]))
+                if lon != lon or lat != lat:
+                    raise ValueError
+            except (TypeError, ValueError):
+                raise HTTPError(400, "point %d is not a [lon, lat] pair"
+                                % k)
+            pts.append((lon, lat))
+        rank = _specificity_ranks().__getitem__
+        out = []
+        for hits in _points_query(pts, precise, resolution):
+            if smallest_first and len(hits) > 1:
+                hits.sort(key=rank)
+            out.append(_json_list(frags, hits))
+        return (len(pts), '{"results":[' + ','.join(out) + ']}')
+
+    def _bbox(self, params):
+        frags = self.server.encoder.fragments(_fields(params.get('fields')))
+        window = [_number(params, n) for n in ('lon1', 'lat1', 'lon2',
+                                               'lat2')]
+        query = country_subunits_within_bbox \
+            if _flag(params.get('within')) \
+            else country_subunits_intersecting_bbox
+        hits = [c._row for c in query(*window)]
+        return '{"subunits":' + _json_list(frags, hits) + '}'
+
+    def _iso(self, code, params):
+        frags = self.server.encoder.fragments(_fields(params.get('fields')))
+        hits = [c._row for c in country_subunits_by_iso_code(code)]
+        return '{"subunits":' + _json_list(frags, hits) + '}'
+
+    def log_message(self, format, *args):
+        if self.server.access_log:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def make_server(host=DEFAULT_HOST, port=DEFAULT_PORT, preload_levels=(),
+                access_log=False):
+    """
+    Return a LookupServer listening on host and port (0 picks a free
+    port), ready to serve_forever().
+    """
+    return LookupServer((host, port), preload_levels, access_log)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m country_bounding_boxes.server',
+        description="Serve country subunit lookups as JSON over HTTP.")
+    parser.add_argument('--host', default=DEFAULT_HOST,
+                        help="address to listen on (default: %s)"
+                             % DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help="port to listen on (default: %d)"
+                             % DEFAULT_PORT)
+    parser.add_argument('--preload', action='append', default=[],
+                        choices=_polygons.LEVELS, metavar='RESOLUTION',
+                        help="load the outlines at RESOLUTION for precise "
+                             "lookups before serving (may be repeated)")
+    parser.add_argument('--access-log', action='store_true',
+                        help="log each request to standard error")
+    args = parser.parse_args(argv)
+    server = make_server(args.host, args.port, args.preload,
+                         args.access_log)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
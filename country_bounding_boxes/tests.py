@@ -1,7 +1,18 @@
-from unittest import TestCase
+import sys
+from unittest import TestCase, skipIf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from country_bounding_boxes import _data, _quadkey_index
+from country_bounding_boxes.index import QuadkeyIndex, STRTree
 
 from country_bounding_boxes import (
+    all_country_subunits,
     country_subunits_containing_point as by_point,
+    country_subunits_intersecting_bbox as by_bbox,
     country_subunits_by_iso_code as by_code,
 )
 
@@ -36,6 +47,13 @@ class TestCountries(TestCase):
         self.assertEqual(code_to_names('Tm'), ['Turkmenistan'])
         self.assertEqual(code_to_names('Tkm'), ['Turkmenistan'])
 
+    def test_codes_patched(self):
+        self.assertEqual(code_to_names('GI'), ['Gibraltar'])
+        self.assertEqual(code_to_names('TUV'), ['Tuvalu'])
+        self.assertEqual([c.bbox for c in by_code('PRT')
+                          if c.name == 'Madeira'],
+                         [(-17.3, 32.4, -16.25, 33.15)])
+
     def test_codes_missing(self):
         self.assertEqual(code_to_names('ZZ'), [])
         self.assertEqual(code_to_names('LFQ'), [])
@@ -62,3 +80,1198 @@ class TestCountries(TestCase):
     def test_point_4(self):
         cs = point_to_names(lon=-79.888252, lat=32.819747)
         self.assertEqual(cs, ['U.S.A.'])
+
+
+def linear_scan(lon, lat):
+    res = []
+    for c in all_country_subunits():
+        (lon1, lat1, lon2, lat2) = c.bbox
+        if lon1 <= lon <= lon2 and lat1 <= lat <= lat2:
+            res.append(c)
+    return res
+
+
+def sample_points():
+    # A coarse sweep of the world plus every bbox corner, where the
+    # inclusive edge comparisons matter most.
+    for lon in range(-180, 181, 7):
+        for lat in range(-90, 91, 7):
+            yield (float(lon), float(lat))
+    for c in all_country_subunits():
+        (lon1, lat1, lon2, lat2) = c.bbox
+        for p in [(lon1, lat1), (lon2, lat2), (lon1, lat2), (lon2, lat1)]:
+            yield p
+    yield (180.0, 90.0)
+    yield (200.0, 10.0)
+    yield (float('nan'), 10.0)
+
+
+class TestQuadkeyIndex(TestCase):
+
+    def test_matches_linear_scan(self):
+        for (lon, lat) in sample_points():
+            self.assertEqual(list(by_point(lon, lat)),
+                             linear_scan(lon, lat))
+
+    def test_near_edges(self):
+        # Just inside and just outside every box edge, where cells stop
+        # resolving.
+        for c in all_country_subunits():
+            (lon1, lat1, lon2, lat2) = c.bbox
+            (lon, lat) = ((lon1 + lon2) / 2, (lat1 + lat2) / 2)
+            for d in (-1e-7, 1e-7):
+                for p in [(lon1 + d, lat), (lon2 + d, lat),
+                          (lon, lat1 + d), (lon, lat2 + d)]:
+                    self.assertEqual(list(by_point(*p)), linear_scan(*p))
+
+    def test_shipped_table_matches_build(self):
+        from country_bounding_boxes import countries
+        (top_depth, max_depth, cells, splits, list_offsets, list_items) = \
+            countries.table.quadkeys
+        built = QuadkeyIndex.build(countries.bboxes(), top_depth, max_depth)
+        self.assertEqual(list(cells), built.cells)
+        self.assertEqual(list(splits), built.splits)
+        self.assertEqual(list(list_offsets), built.list_offsets)
+        self.assertEqual(list(list_items), built.list_items)
+
+    def test_query_points(self):
+        index = _quadkey_index()
+        pts = list(sample_points())
+        got = index.query_points(pts)
+        self.assertEqual(got, [index.query_point(lon, lat)
+                               for (lon, lat) in pts])
+        self.assertEqual(index.query_points([]), [])
+
+    def test_labels(self):
+        # One box covering the western hemisphere exactly and a small one
+        # inside it: the big box's interior resolves at the top level,
+        # and only the small box's edges need testing.
+        index = QuadkeyIndex.build([(-180, -90, 0, 90), (-10, 10, -5, 15)],
+                                   top_depth=2, max_depth=6)
+        self.assertEqual(index.query_point(-100, 0), [0])
+        self.assertEqual(index.query_point(100, 0), [])
+        self.assertEqual(index.query_point(-7, 12), [0, 1])
+        self.assertEqual(index.query_point(0, 0), [0])
+        self.assertEqual(index.query_point(1e-9, 0), [])
+        k = index.cells[0] >> 2
+        self.assertEqual(index.list_items[index.list_offsets[k]:
+                                          index.list_offsets[k + 1]], [0])
+        self.assertTrue(0.95 < index.resolved_fraction() < 1)
+        self.assertEqual(QuadkeyIndex.build([]).query_point(0, 0), [])
+
+
+class TestSTRTree(TestCase):
+
+    def test_point_matches_linear_scan(self):
+        tree = STRTree([c.bbox for c in all_country_subunits()])
+        cs = list(all_country_subunits())
+        for (lon, lat) in sample_points():
+            self.assertEqual([cs[i] for i in tree.query_point(lon, lat)],
+                             linear_scan(lon, lat))
+
+    def test_nodes_are_full(self):
+        tree = STRTree([(i, i, i + 1, i + 1) for i in range(100)],
+                       capacity=8)
+        leaves = tree.nodes[tree.leaf_start:]
+        self.assertEqual(sorted(tree.items), list(range(100)))
+        self.assertEqual([n[5] - n[4] for n in leaves],
+                         [8] * 12 + [4])
+
+    def test_empty(self):
+        self.assertEqual(STRTree([]).query_point(0, 0), [])
+
+    def test_bbox(self):
+        cs = point_to_names(lon=5.983333, lat=50.883333)
+        self.assertEqual(sorted(c.name for c in
+                                by_bbox(5.983333, 50.883333,
+                                        5.983333, 50.883333)), cs)
+        for (lon1, lat1, lon2, lat2) in [(-10, 35, 5, 45),
+                                         (100, -50, 180, -10),
+                                         (-180, -90, 180, 90)]:
+            expect = [c for c in all_country_subunits()
+                      if c.bbox[0] <= lon2 and lon1 <= c.bbox[2] and
+                      c.bbox[1] <= lat2 and lat1 <= c.bbox[3]]
+            self.assertEqual(list(by_bbox(lon1, lat1, lon2, lat2)), expect)
+
+
+@skipIf(numpy is None, "numpy is not installed")
+class TestBatch(TestCase):
+
+    def test_matches_single_lookups(self):
+        from country_bounding_boxes.batch import (
+            country_subunits_containing_points as by_points)
+        cs = list(all_country_subunits())
+        pts = list(sample_points())
+        lons = numpy.array([p[0] for p in pts])
+        lats = numpy.array([p[1] for p in pts])
+        for chunk_size in [1, 7, 100000]:
+            (offsets, indices) = by_points(lons, lats, chunk_size=chunk_size)
+            self.assertEqual(len(offsets), len(pts) + 1)
+            for (k, (lon, lat)) in enumerate(pts):
+                got = indices[offsets[k]:offsets[k + 1]]
+                self.assertEqual([cs[i] for i in got], linear_scan(lon, lat))
+
+    def test_empty(self):
+        from country_bounding_boxes.batch import (
+            country_subunits_containing_points as by_points)
+        (offsets, indices) = by_points([], [])
+        self.assertEqual(list(offsets), [0])
+        self.assertEqual(list(indices), [])
+
+
+class TestDataFile(TestCase):
+
+    def test_matches_generated(self):
+        from country_bounding_boxes import generated
+        table = _data.load()
+        self.assertEqual(table.fields, generated.Country._fields[1:])
+        self.assertEqual(table.rows, len(generated.countries))
+        for (i, c) in enumerate(generated.countries):
+            d = table.country(i)
+            self.assertEqual(d, c)
+            self.assertEqual([type(v) for v in d], [type(v) for v in c])
+
+    def test_round_trip(self):
+        import os
+        import tempfile
+        rows = [((1.0, 2.0, 3.0, 4.0), u'Sao Tom\xe9', 1, 1.0, -99.0),
+                ((-180.0, -90.0, 180.0, 90.0), u'', 2, 0.5, u'-99')]
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            _data.write(path, ['a', 'b', 'c', 'd'], rows)
+            table = _data.load(path)
+        finally:
+            os.remove(path)
+        if str is bytes:
+            # Python 2 strings come back as UTF-8 str, as in generated.py.
+            rows = [tuple(v.encode('utf-8') if isinstance(v, type(u'')) else v
+                          for v in r) for r in rows]
+        self.assertEqual([tuple(table.country(i)) for i in range(2)],
+                         [tuple(r) for r in rows])
+        self.assertEqual(type(table.get(0, 'b')), int)
+        self.assertEqual(type(table.get(0, 'c')), float)
+
+    def test_slices(self):
+        from country_bounding_boxes import countries, generated
+        cs = generated.countries
+        self.assertEqual(countries[0:3], cs[0:3])
+        self.assertEqual(countries[-2:], cs[-2:])
+        self.assertEqual(countries[::50], cs[::50])
+        self.assertEqual(countries[5:2], [])
+        self.assertEqual(countries[-1], cs[-1])
+
+    def test_shared(self):
+        table = _data.load()
+        shared = _data.load(shared=True)
+        self.assertEqual(shared.fields, table.fields)
+        self.assertEqual(shared.bboxes, table.bboxes)
+        for i in range(table.rows):
+            self.assertEqual(tuple(shared.country(i)),
+                             tuple(table.country(i)))
+        self.assertEqual(shared.iso_3_index, table.iso_3_index)
+        self.assertEqual([list(a) for a in shared.quadkeys[2:]],
+                         [list(a) for a in table.quadkeys[2:]])
+        if _data._ZERO_COPY:
+            self.assertTrue(isinstance(shared._strings, memoryview))
+            self.assertEqual(shared._values, None)
+
+    def test_shared_environment(self):
+        import os
+        import subprocess
+        script = ("import country_bounding_boxes as cbb\n"
+                  "print(cbb.countries.table._values is None)\n")
+        for (value, shared) in [('1', True), ('Yes', True), (' on ', True),
+                                ('true', True), ('0', False),
+                                ('false', False), ('off', False),
+                                ('', False)]:
+            env = dict(os.environ, COUNTRY_BOUNDING_BOXES_SHARED=value)
+            out = subprocess.check_output([sys.executable, '-c', script],
+                                          env=env)
+            self.assertEqual(out.strip(), str(shared).encode('ascii'))
+
+    def test_lazy(self):
+        table = _data.load()
+        self.assertEqual((table._bboxes, table._iso_indexes), (None, {}))
+        countries = _data.CountryList(table)
+        countries.bboxes()
+        countries.column('subunit')
+        self.assertEqual(countries._records.count(None), len(countries))
+
+    def test_shipped_rtree_matches_build(self):
+        table = _data.load()
+        built = STRTree(table.bboxes)
+        loaded = STRTree.from_arrays(table.bboxes, *table.rtree)
+        self.assertEqual(loaded.nodes, built.nodes)
+        self.assertEqual(list(loaded.items), list(built.items))
+        self.assertEqual(loaded.leaf_start, built.leaf_start)
+        for (lon, lat) in sample_points():
+            self.assertEqual(loaded.query_point(lon, lat),
+                             built.query_point(lon, lat))
+            self.assertEqual(loaded.nearest(lon, lat, 3),
+                             built.nearest(lon, lat, 3))
+
+
+class TestRecords(TestCase):
+
+    def test_country_compatible(self):
+        import pickle
+        from country_bounding_boxes import Country, countries
+        table = countries.table
+        r = table.record(0)
+        c = table.country(0)
+        self.assertEqual(r, c)
+        self.assertEqual(c, r)
+        self.assertEqual(hash(r), hash(c))
+        self.assertEqual(tuple(r), tuple(c))
+        self.assertEqual(len(r), len(c))
+        self.assertEqual(r[0], c.bbox)
+        self.assertEqual(r[-1], c[-1])
+        self.assertEqual((r.name, r.iso_a3, r.pop_est),
+                         (c.name, c.iso_a3, c.pop_est))
+        self.assertEqual(r._fields, Country._fields)
+        self.assertEqual(r._asdict(), c._asdict())
+        self.assertEqual(r._replace(name='X'), c._replace(name='X'))
+        self.assertNotEqual(r, table.record(1))
+        self.assertEqual(pickle.loads(pickle.dumps(r)), c)
+        self.assertRaises(AttributeError, getattr, r, 'nonesuch')
+
+    def test_indexing_and_ordering(self):
+        from country_bounding_boxes import countries
+        table = countries.table
+        (r, c) = (table.record(3), table.country(3))
+        for k in range(-len(c), len(c)):
+            self.assertEqual(r[k], c[k])
+        self.assertEqual(r[2:5], c[2:5])
+        self.assertRaises(IndexError, lambda: r[len(c)])
+        rs = [table.record(i) for i in range(10)]
+        cs = [table.country(i) for i in range(10)]
+        self.assertEqual(sorted(rs), sorted(cs))
+        self.assertEqual(max(rs), max(cs))
+        self.assertEqual((rs[0] < rs[1], rs[0] <= c, rs[0] > cs[1],
+                          rs[1] >= rs[1]),
+                         (cs[0] < cs[1], cs[0] <= c, cs[0] > cs[1], True))
+
+    def test_slots(self):
+        r = next(by_code('ZW'))
+        self.assertFalse(hasattr(r, '__dict__'))
+
+
+class TestColumns(TestCase):
+
+    def test_columns(self):
+        from country_bounding_boxes import country_subunit_columns
+        cols = country_subunit_columns()
+        cs = list(all_country_subunits())
+        self.assertEqual(len(cols), len(cs))
+        self.assertEqual(list(cols.pop_est), [c.pop_est for c in cs])
+        self.assertEqual(list(cols['gdp_md_est']),
+                         [c.gdp_md_est for c in cs])
+        self.assertEqual(cols.name, [c.name for c in cs])
+        self.assertEqual(list(zip(cols.lon1, cols.lat1, cols.lon2, cols.lat2)),
+                         [c.bbox for c in cs])
+        self.assertEqual(cols.pop_est.typecode, 'd')
+        africa = [c for c in cols.continent if c == 'Africa']
+        self.assertTrue(africa[0] is africa[-1])
+        self.assertTrue(cols.iso_a3 is cols.iso_a3)
+        self.assertRaises(KeyError, lambda: cols['nonesuch'])
+        self.assertRaises(AttributeError, lambda: cols.nonesuch)
+
+    def test_filter_and_rank(self):
+        from country_bounding_boxes import country_subunit_columns
+        cols = country_subunit_columns()
+        europe = [i for (i, c) in enumerate(cols.continent) if c == 'Europe']
+        top = max(europe, key=cols.pop_est.__getitem__)
+        self.assertEqual(cols.name[top], 'Russia')
+
+
+class TestIsoIndex(TestCase):
+
+    def test_grouped_by_iso_3(self):
+        from country_bounding_boxes import (
+            all_country_subunits_grouped_by_iso_3_code as grouped)
+        groups = dict(grouped())
+        self.assertEqual(sorted(c.name for c in groups['ZWE']), ['Zimbabwe'])
+        self.assertTrue(isinstance(groups['GBR'], set))
+        self.assertEqual(set(c for cs in groups.values() for c in cs),
+                         set(all_country_subunits()))
+
+    def test_built_per_code(self):
+        import country_bounding_boxes
+        country_bounding_boxes._iso_caches = None
+        self.assertEqual(code_to_names('fr'), code_to_names('FRA'))
+        self.assertEqual(code_to_names('QQ'), [])
+        self.assertEqual(code_to_names('FRANCE'), [])
+        (iso_2_cache, iso_3_cache) = country_bounding_boxes._iso_caches
+        self.assertEqual((list(iso_2_cache), list(iso_3_cache)),
+                         (['FR'], ['FRA']))
+
+    def test_shipped_index(self):
+        table = _data.load()
+        self.assertEqual(sorted(table.country(i).name
+                                for i in table.iso_2_index['GB']),
+                         ['England', 'N. Ireland', 'Scotland', 'Wales'])
+        self.assertEqual(table.iso_2_index['GB'], table.iso_3_index['GBR'])
+
+
+class TestThreads(TestCase):
+
+    def test_concurrent_first_lookups(self):
+        import threading
+        import country_bounding_boxes
+        codes = ['GB', 'GBR', 'IT', 'ITA', 'US', 'FRA', 'ZW', 'TUV']
+        expect = dict((code, code_to_names(code)) for code in codes)
+        errors = []
+
+        def hammer(start):
+            start.wait()
+            for _ in range(20):
+                for code in codes:
+                    got = sorted(c.name for c in by_code(code))
+                    if got != expect[code]:
+                        errors.append((code, got))
+
+        # Switch threads as often as possible to widen any race window
+        # (Python 2 counts bytecodes between switches rather than time).
+        if hasattr(sys, 'setswitchinterval'):
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+            self.addCleanup(sys.setswitchinterval, interval)
+        else:
+            interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+            self.addCleanup(sys.setcheckinterval, interval)
+
+        for attempt in range(10):
+            # Start every round from unbuilt caches.
+            country_bounding_boxes._iso_caches = None
+            start = threading.Event()
+            threads = [threading.Thread(target=hammer, args=(start,))
+                       for _ in range(16)]
+            for t in threads:
+                t.start()
+            start.set()
+            for t in threads:
+                t.join()
+        self.assertEqual(errors, [])
+
+
+class TestDependencies(TestCase):
+
+    def test_no_iso3166_at_runtime(self):
+        import os
+        import subprocess
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = ("import sys\n"
+                  "import country_bounding_boxes as cbb\n"
+                  "list(cbb.country_subunits_by_iso_code('GB'))\n"
+                  "list(cbb.country_subunits_containing_point(0, 0))\n"
+                  "assert 'iso3166' not in sys.modules\n")
+        subprocess.check_call([sys.executable, '-c', script], cwd=root)
+
+
+def window_scan(lon1, lat1, lon2, lat2, within):
+    if lon1 > lon2:
+        parts = [(lon1, lat1, 180.0, lat2), (-180.0, lat1, lon2, lat2)]
+    else:
+        parts = [(lon1, lat1, lon2, lat2)]
+    res = []
+    for c in all_country_subunits():
+        (a, b, c2, d) = c.bbox
+        for (x1, y1, x2, y2) in parts:
+            if within:
+                hit = x1 <= a and c2 <= x2 and y1 <= b and d <= y2
+            else:
+                hit = a <= x2 and x1 <= c2 and b <= y2 and y1 <= d
+            if hit:
+                res.append(c)
+                break
+    return res
+
+
+class TestWindows(TestCase):
+
+    windows = [(-10, 35, 5, 45), (170, -25, -170, -10), (179, -90, -179, 90),
+               (100, -50, 180, -10), (-180, -90, 180, 90), (10, 10, 10, 10),
+               (5, 45, -10, 35)]
+
+    def test_intersecting(self):
+        for w in self.windows:
+            self.assertEqual(list(by_bbox(*w)), window_scan(*w, within=False))
+
+    def test_within(self):
+        from country_bounding_boxes import country_subunits_within_bbox
+        for w in self.windows:
+            self.assertEqual(list(country_subunits_within_bbox(*w)),
+                             window_scan(*w, within=True))
+
+    def test_antimeridian(self):
+        names = sorted(set(c.name for c in by_bbox(178, -20, -178, -15)))
+        self.assertTrue('Fiji' in names)
+        self.assertFalse('Brazil' in names)
+        self.assertTrue(set(['Fiji', 'Tonga']) <= set(
+            c.name for c in by_bbox(170, -25, -170, -10)))
+
+
+class TestSpecificity(TestCase):
+
+    def test_area(self):
+        import math
+        from country_bounding_boxes.index import EARTH_RADIUS_KM, \
+            box_area_km2
+        # The whole globe, and a box either side of the date line.
+        self.assertAlmostEqual(box_area_km2((-180, -90, 180, 90)),
+                               4 * math.pi * EARTH_RADIUS_KM ** 2)
+        self.assertAlmostEqual(box_area_km2((170, -10, -170, 10)),
+                               box_area_km2((-10, -10, 10, 10)))
+        self.assertEqual(box_area_km2((5, 5, 5, 5)), 0.0)
+
+    def test_smallest_first(self):
+        from country_bounding_boxes import (
+            smallest_country_subunit_containing_point as smallest)
+        cs = list(by_point(-5.35, 36.13, smallest_first=True))
+        self.assertEqual([c.name for c in cs],
+                         ['Gibraltar', 'Spain', 'Algeria'])
+        self.assertEqual(smallest(-5.35, 36.13), cs[0])
+        self.assertEqual(smallest(0.0, -85.0), None)
+        for (lon, lat) in sample_points():
+            cs = list(by_point(lon, lat, smallest_first=True))
+            self.assertEqual(sorted(cs, key=lambda c: c.bbox),
+                             sorted(linear_scan(lon, lat),
+                                    key=lambda c: c.bbox))
+            self.assertEqual(smallest(lon, lat), cs[0] if cs else None)
+
+
+class TestPointCache(TestCase):
+
+    def test_matches_linear_scan(self):
+        from country_bounding_boxes.cache import PointCache
+        cache = PointCache(precision=1)
+        for _ in range(2):
+            for (lon, lat) in sample_points():
+                self.assertEqual(list(cache(lon, lat)),
+                                 linear_scan(lon, lat))
+        self.assertTrue(cache.hits > 0)
+
+    def test_edges_are_exact(self):
+        from country_bounding_boxes.cache import PointCache
+        # Gibraltar's eastern edge runs through this cell, so the answer
+        # depends on which side of it the point falls.
+        cache = PointCache(precision=2)
+        self.assertEqual([c.name for c in cache(-5.3361, 36.13)],
+                         ['Algeria', 'Spain', 'Gibraltar'])
+        self.assertEqual([c.name for c in cache(-5.3359, 36.13)],
+                         ['Algeria', 'Spain'])
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_counters_and_eviction(self):
+        from country_bounding_boxes.cache import PointCache
+        cache = PointCache(precision=0, maxsize=2)
+        for (lon, lat) in [(-100.5, 40.5), (-100.7, 40.2), (20.5, 0.5),
+                           (-100.5, 40.5), (-40.5, -20.5), (20.5, 0.5)]:
+            list(cache(lon, lat))
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual([c.name for c in
+                          cache(-100.5, 40.5, smallest_first=True)],
+                         ['U.S.A.'])
+        cache.clear()
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+        self.assertRaises(ValueError, PointCache, maxsize=0)
+        for precision in (-1, 8, 12, 2.5):
+            self.assertRaises(ValueError, PointCache, precision=precision)
+
+    def test_precision_range(self):
+        from country_bounding_boxes.cache import MAX_PRECISION, PointCache
+        pts = [p for p in sample_points() if p[0] == p[0]]
+        for precision in (0, MAX_PRECISION):
+            lookup = PointCache(precision=precision)
+            for (lon, lat) in pts:
+                self.assertEqual(list(lookup(lon, lat)),
+                                 linear_scan(lon, lat))
+
+
+class TestCommandLine(TestCase):
+
+    def tag(self, text, fmt, **kwargs):
+        import io
+        from country_bounding_boxes.cli import Tagger, tag_stream
+        out = io.StringIO()
+        tag_stream(io.StringIO(text), out, fmt,
+                   Tagger(all_matches=kwargs.pop('all_matches', False)),
+                   **kwargs)
+        return out.getvalue()
+
+    @skipIf(sys.version_info < (3, ), "text streams differ on Python 2")
+    def test_csv(self):
+        text = (u'id,x,y\n1,-79.888252,32.819747\n"2, b",-5.35,36.13\n'
+                u'3,,\n4,0,0\n')
+        self.assertEqual(self.tag(text, 'csv', lon_field='x', lat_field='y',
+                                  batch_size=2),
+                         u'id,x,y,iso_a2,iso_a3,name\n'
+                         u'1,-79.888252,32.819747,US,USA,U.S.A.\n'
+                         u'"2, b",-5.35,36.13,GI,GIB,Gibraltar\n'
+                         u'3,,,,,\n'
+                         u'4,0,0,,,\n')
+        self.assertEqual(self.tag(u'lon,lat\n-5.35,36.13\n', 'csv',
+                                  all_matches=True, header=False),
+                         u'-5.35,36.13,GI;ES;DZ,GIB;ESP;DZA,'
+                         u'Gibraltar;Spain;Algeria\n')
+        self.assertRaises(ValueError, self.tag, u'a,b\n', 'csv')
+
+    @skipIf(sys.version_info < (3, ), "text streams differ on Python 2")
+    def test_ndjson(self):
+        import io
+        import json
+        text = (u'{"lon": -5.35, "lat": 36.13}\n\n{"lon": "?"}\n'
+                u'{"lon": 0, "lat"\n[1, 2]\n{"lon": 2.35, "lat": 48.85}\n')
+        saved = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            tagged = self.tag(text, 'ndjson', batch_size=2)
+            err = sys.stderr.getvalue()
+        finally:
+            sys.stderr = saved
+        out = [json.loads(line) for line in tagged.splitlines()]
+        self.assertEqual(out, [
+            {'lon': -5.35, 'lat': 36.13, 'iso_a2': 'GI', 'iso_a3': 'GIB',
+             'name': 'Gibraltar'},
+            {'lon': '?', 'iso_a2': None, 'iso_a3': None, 'name': None},
+            {'lon': 2.35, 'lat': 48.85, 'iso_a2': 'FR', 'iso_a3': 'FRA',
+             'name': 'France'}])
+        self.assertEqual(err, u'line 4: not a JSON object, skipped\n'
+                              u'line 5: not a JSON object, skipped\n')
+        out = json.loads(self.tag(text, 'ndjson', all_matches=True)
+                         .splitlines()[0])
+        self.assertEqual(out['iso_a3'], ['GIB', 'ESP', 'DZA'])
+
+    def test_codes_match_iso_index(self):
+        from country_bounding_boxes.cli import Tagger
+        labels = Tagger().labels
+        for (i, c) in enumerate(all_country_subunits()):
+            if labels[i][1]:
+                self.assertTrue(c in by_code(labels[i][1]))
+                self.assertTrue(c in by_code(labels[i][0]))
+
+    def test_main(self):
+        import json
+        import subprocess
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'country_bounding_boxes', '-f',
+             'ndjson'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        (out, err) = proc.communicate(b'not json\n'
+                                      b'{"lon": 5.983333, "lat": 50.883333}\n')
+        self.assertEqual(proc.returncode, 0)
+        # Python 2 does not keep the keys in order.
+        self.assertEqual(json.loads(out.decode('utf-8')),
+                         {'lon': 5.983333, 'lat': 50.883333,
+                          'iso_a2': 'NL', 'iso_a3': 'NLD',
+                          'name': 'Netherlands'})
+        self.assertEqual(err.decode('utf-8').strip(),
+                         'line 1: not a JSON object, skipped')
+
+
+class TestParallel(TestCase):
+
+    def test_matches_single_lookups(self):
+        from country_bounding_boxes.parallel import (
+            country_subunits_containing_points as by_points)
+        pts = list(sample_points())
+        got = list(by_points(iter(pts), processes=3, chunk_size=50,
+                             smallest_first=True))
+        self.assertEqual(got, [list(by_point(lon, lat, smallest_first=True))
+                               for (lon, lat) in pts])
+        self.assertEqual(list(by_points([], processes=2)), [])
+        self.assertRaises(ValueError, by_points, pts, processes=0)
+        self.assertRaises(ValueError, by_points, pts, chunk_size=0)
+
+    @skipIf(sys.version_info < (3, ), "text streams differ on Python 2")
+    def test_command_line_jobs(self):
+        import io
+        from country_bounding_boxes.cli import Tagger, tag_stream
+        text = u'lon,lat\n' + u''.join(u'%r,%r\n' % p
+                                       for p in sample_points())
+        outs = []
+        for jobs in (1, 3):
+            out = io.StringIO()
+            tag_stream(io.StringIO(text), out, 'csv', Tagger(),
+                       batch_size=40, jobs=jobs)
+            outs.append(out.getvalue())
+        self.assertEqual(outs[0], outs[1])
+
+
+@skipIf(sys.version_info < (3, 5), "needs async/await")
+class TestAsync(TestCase):
+
+    def run_lookups(self, service, points, **kwargs):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            lookup = service.country_subunits_containing_point
+            tasks = [loop.create_task(lookup(lon, lat, **kwargs))
+                     for (lon, lat) in points]
+            return loop.run_until_complete(asyncio.gather(*tasks))
+        finally:
+            loop.close()
+
+    def test_matches_single_lookups(self):
+        from country_bounding_boxes.aio import PointLookupService
+        service = PointLookupService(max_batch=100)
+        pts = list(sample_points())
+        got = self.run_lookups(service, pts, smallest_first=True)
+        self.assertEqual(got, [list(by_point(lon, lat, smallest_first=True))
+                               for (lon, lat) in pts])
+        self.assertEqual(service.points, len(pts))
+        self.assertEqual(service.batches, (len(pts) + 99) // 100)
+
+    def test_coalesces_within_delay(self):
+        from country_bounding_boxes.aio import PointLookupService
+        service = PointLookupService(max_delay=0.01)
+        got = self.run_lookups(service, [(-5.35, 36.13)] * 10)
+        self.assertEqual([[c.name for c in cs] for cs in got],
+                         [['Algeria', 'Spain', 'Gibraltar']] * 10)
+        self.assertEqual((service.batches, service.points), (1, 10))
+
+    def test_coalesces_within_a_pass(self):
+        from country_bounding_boxes.aio import PointLookupService
+        service = PointLookupService()
+        got = self.run_lookups(service, [(-5.35, 36.13), (0.0, 0.0)] * 5)
+        self.assertEqual([len(cs) for cs in got], [3, 0] * 5)
+        self.assertEqual((service.batches, service.points), (1, 10))
+
+    def test_bulk_lookups(self):
+        import asyncio
+        from country_bounding_boxes.aio import PointLookupService
+        service = PointLookupService(max_batch=100)
+        pts = list(sample_points())
+        bulk = service.country_subunits_containing_points
+        loop = asyncio.new_event_loop()
+        try:
+            tasks = [loop.create_task(c) for c in [
+                bulk(iter(pts), smallest_first=True),
+                service.country_subunits_containing_point(-5.35, 36.13),
+                bulk([])]]
+            (got, one, none) = loop.run_until_complete(
+                asyncio.gather(*tasks))
+        finally:
+            loop.close()
+        self.assertEqual(got, [list(by_point(lon, lat, smallest_first=True))
+                               for (lon, lat) in pts])
+        self.assertEqual([c.name for c in one],
+                         ['Algeria', 'Spain', 'Gibraltar'])
+        self.assertEqual(none, [])
+        # The bulk lookup filled a batch on its own, and went at once.
+        self.assertEqual((service.batches, service.points),
+                         (2, len(pts) + 1))
+
+
+class TestServer(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        import threading
+        from country_bounding_boxes.server import make_server
+        cls.server = make_server(port=0)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        try:
+            from http.client import HTTPConnection
+        except ImportError:
+            from httplib import HTTPConnection
+        self.conn = HTTPConnection('127.0.0.1',
+                                   self.server.server_address[1])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def request(self, method, path, body=None):
+        import json
+        self.conn.request(method, path, body)
+        res = self.conn.getresponse()
+        return (res.status, json.loads(res.read().decode('utf-8')))
+
+    def names(self, subunits):
+        return [c['name'] for c in subunits]
+
+    def test_lookups(self):
+        (status, res) = self.request(
+            'GET', '/point?lon=-5.35&lat=36.13&smallest_first=1')
+        self.assertEqual(status, 200)
+        self.assertEqual(self.names(res['subunits']),
+                         ['Gibraltar', 'Spain', 'Algeria'])
+        gib = res['subunits'][0]
+        self.assertEqual(gib['iso_a3'], 'GIB')
+        self.assertEqual(sorted(gib), sorted(next(all_country_subunits())
+                                             ._fields))
+        (_, res) = self.request('GET', '/bbox?lon1=-6&lat1=36&lon2=-5'
+                                       '&lat2=37&fields=name')
+        self.assertEqual(res['subunits'],
+                         [{'name': c.name} for c in by_bbox(-6, 36, -5, 37)])
+        (_, res) = self.request('GET', '/iso/gb?fields=name,iso_a2')
+        self.assertEqual(sorted(self.names(res['subunits'])),
+                         code_to_names('GB'))
+
+    def test_batch(self):
+        import json
+        pts = [p for p in sample_points() if p[0] == p[0]]
+        (status, res) = self.request('POST', '/points', json.dumps(
+            {'points': pts, 'smallest_first': True, 'fields': ['name']}))
+        self.assertEqual(status, 200)
+
+        def text(s):
+            # Names are UTF-8 str on Python 2, and JSON gives unicode.
+            return s.decode('utf-8') if isinstance(s, bytes) else s
+
+        self.assertEqual(res['results'],
+                         [[{'name': text(c.name)}
+                           for c in by_point(lon, lat, smallest_first=True)]
+                          for (lon, lat) in pts])
+
+    def test_errors(self):
+        import json
+        for (method, path, body, status) in [
+                ('GET', '/point?lon=1', None, 400),
+                ('GET', '/point?lon=x&lat=1', None, 400),
+                ('GET', '/point?lon=1&lat=1&fields=nope', None, 400),
+                ('GET', '/point?lon=1&lat=1&resolution=1m', None, 400),
+                ('GET', '/nowhere', None, 404),
+                ('POST', '/points', '{', 400),
+                ('POST', '/points', json.dumps({'points': [[1]]}), 400),
+                ('POST', '/points', json.dumps({'points': ['12']}), 400),
+                ('POST', '/points', json.dumps({'points': [[1, 2, 3]]}),
+                 400),
+                ('POST', '/point', '{}', 405)]:
+            self.assertEqual(self.request(method, path, body)[0], status)
+            # The connection is kept alive, or reopened if the server had
+            # to close it.
+            self.assertEqual(self.request('GET', '/iso/FR')[0], 200)
+
+    def test_negative_length(self):
+        import socket
+        sock = socket.create_connection(('127.0.0.1',
+                                         self.server.server_address[1]),
+                                        timeout=5)
+        try:
+            sock.sendall(b'POST /points HTTP/1.1\r\nHost: x\r\n'
+                         b'Content-Length: -1\r\n\r\n')
+            # The server closes the connection after answering; read up to
+            # that, rather than hang up on it mid-response.
+            chunks = []
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            self.assertTrue(b''.join(chunks).startswith(b'HTTP/1.1 400'))
+        finally:
+            sock.close()
+
+    def test_posts_elsewhere_are_not_endpoints(self):
+        for k in range(3):
+            self.request('POST', '/junk%d' % k, '{}')
+        (_, m) = self.request('GET', '/metrics')
+        self.assertFalse([e for e in m if e.startswith('junk')])
+        self.assertTrue(m['other']['requests'] >= 3)
+
+    def test_metrics(self):
+        for _ in range(3):
+            self.request('GET', '/point?lon=0&lat=0')
+        (_, m) = self.request('GET', '/metrics')
+        self.assertTrue(m['point']['requests'] >= 3)
+        self.assertEqual(sum(b['requests'] for b in m['point']['buckets']),
+                         m['point']['requests'])
+        self.assertTrue(m['point']['max_ms'] >= m['point']['mean_ms'])
+
+
+class TestNearest(TestCase):
+
+    points = [(-20.0, 30.0), (0.0, 0.0), (-150.0, -40.0), (179.9, 60.0),
+              (27.5125, -21.173611), (0.0, 89.9), (-60.0, -89.0)]
+
+    def brute(self, lon, lat, distance):
+        return sorted((distance(c.bbox, lon, lat), i)
+                      for (i, c) in enumerate(all_country_subunits()))
+
+    def test_matches_brute_force(self):
+        from country_bounding_boxes import country_subunits_nearest_to_point
+        from country_bounding_boxes.index import (
+            box_distance_degrees, box_distance_km)
+        cs = list(all_country_subunits())
+        for (metric, distance) in [('great_circle', box_distance_km),
+                                   ('planar', box_distance_degrees)]:
+            for (lon, lat) in self.points:
+                expect = [(d, cs[i]) for (d, i)
+                          in self.brute(lon, lat, distance)[:5]]
+                got = list(country_subunits_nearest_to_point(
+                    lon, lat, k=5, metric=metric))
+                self.assertEqual(got, expect)
+
+    def test_max_distance(self):
+        from country_bounding_boxes import country_subunits_nearest_to_point
+        got = list(country_subunits_nearest_to_point(-20.0, 30.0, k=100,
+                                                     max_distance=500))
+        self.assertTrue(got)
+        self.assertTrue(all(d <= 500 for (d, _) in got))
+        self.assertEqual(list(country_subunits_nearest_to_point(
+            -140.0, -50.0, max_distance=10)), [])
+
+    def test_containing_first(self):
+        from country_bounding_boxes import country_subunits_nearest_to_point
+        got = list(country_subunits_nearest_to_point(-79.888252, 32.819747))
+        self.assertEqual([(d, c.name) for (d, c) in got], [(0.0, 'U.S.A.')])
+
+    def test_bad_input(self):
+        from country_bounding_boxes import country_subunits_nearest_to_point
+        for (lon, lat) in [(float('nan'), 0.0), (0.0, float('nan')),
+                           (float('inf'), 0.0), (0.0, float('-inf'))]:
+            self.assertEqual(
+                list(country_subunits_nearest_to_point(lon, lat, k=3)), [])
+        self.assertRaises(ValueError, country_subunits_nearest_to_point,
+                          0.0, 0.0, k=2.5)
+        self.assertEqual(
+            len(list(country_subunits_nearest_to_point(0.0, 0.0, k=2.0))), 2)
+
+    def test_box_distance_km(self):
+        # Compare against a dense sampling of each box's outline.
+        import math
+        from country_bounding_boxes.index import box_distance_km
+
+        def haversine(lon1, lat1, lon2, lat2):
+            (lon1, lat1, lon2, lat2) = map(math.radians,
+                                           (lon1, lat1, lon2, lat2))
+            h = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) *
+                 math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+            return 2 * 6371.0088 * math.asin(min(1.0, math.sqrt(h)))
+
+        box = (10.0, 20.0, 30.0, 60.0)
+        steps = [k / 400.0 for k in range(401)]
+        outline = ([(10.0 + 20.0 * t, 20.0) for t in steps] +
+                   [(10.0 + 20.0 * t, 60.0) for t in steps] +
+                   [(10.0, 20.0 + 40.0 * t) for t in steps] +
+                   [(30.0, 20.0 + 40.0 * t) for t in steps])
+        for (lon, lat) in [(-40.0, 50.0), (100.0, 10.0), (20.0, -10.0),
+                           (-150.0, 70.0), (60.0, 65.0), (0.0, 40.0)]:
+            sampled = min(haversine(lon, lat, x, y) for (x, y) in outline)
+            d = box_distance_km(box, lon, lat)
+            self.assertTrue(d <= sampled + 1e-6)
+            self.assertTrue(sampled - d < 5.0)
+
+
+class TestWithinDistance(TestCase):
+
+    def test_matches_brute_force(self):
+        from country_bounding_boxes import country_subunits_within_distance
+        from country_bounding_boxes.index import box_distance_km
+        for (lon, lat) in TestNearest.points + [(-179.9, -17.0)]:
+            for km in [0, 50, 500, 3000]:
+                expect = [c for c in all_country_subunits()
+                          if box_distance_km(c.bbox, lon, lat) <= km]
+                self.assertEqual(
+                    list(country_subunits_within_distance(lon, lat, km)),
+                    expect)
+
+    def test_antimeridian(self):
+        from country_bounding_boxes import country_subunits_within_distance
+        # Just east of the date line, Fiji's western half is 20-odd km
+        # away across it.
+        names = [c.name for c in
+                 country_subunits_within_distance(-179.9, -17.0, 50)]
+        self.assertEqual(names.count('Fiji'), 2)
+
+    def test_bad_input(self):
+        from country_bounding_boxes import country_subunits_within_distance
+        for (lon, lat) in [(0.0, float('nan')), (float('nan'), 0.0),
+                           (float('-inf'), 10.0)]:
+            self.assertEqual(
+                list(country_subunits_within_distance(lon, lat, 100)), [])
+        for km in [-1, float('nan')]:
+            self.assertRaises(ValueError, country_subunits_within_distance,
+                              0.0, 0.0, km)
+
+    def test_poles(self):
+        from country_bounding_boxes import country_subunits_within_distance
+        # A degree of longitude is under 2 km this close to the pole, so
+        # every longitude is within reach.
+        names = [c.name for c in
+                 country_subunits_within_distance(0.0, 89.99, 1000)]
+        self.assertTrue('Greenland' in names)
+
+
+def square(lon1, lat1, lon2, lat2):
+    return [(lon1, lat1), (lon2, lat1), (lon2, lat2), (lon1, lat2),
+            (lon1, lat1)]
+
+
+def polygons_from(rows):
+    import os
+    import tempfile
+    from country_bounding_boxes import _polygons
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        _polygons.write(path, rows)
+        return _polygons.load(path)
+    finally:
+        os.remove(path)
+
+
+class TestPolygons(TestCase):
+
+    def test_rings(self):
+        # A square with a square hole, two islands, and no outline.
+        p = polygons_from([
+            [square(0, 0, 10, 10), square(4, 4, 6, 6)],
+            [square(0, 0, 1, 1), square(2, 2, 3, 3)],
+            [],
+        ])
+        self.assertTrue(p.contains(0, 2, 2))
+        self.assertFalse(p.contains(0, 5, 5))
+        self.assertFalse(p.contains(0, 11, 5))
+        self.assertTrue(p.contains(1, 0.5, 0.5))
+        self.assertTrue(p.contains(1, 2.5, 2.5))
+        self.assertFalse(p.contains(1, 1.5, 1.5))
+        self.assertTrue(p.contains(2, 50, 50))
+
+    def test_concave(self):
+        # An L shape, whose box covers the missing corner.
+        p = polygons_from([[[(0, 0), (2, 0), (2, 1), (1, 1), (1, 2), (0, 2),
+                             (0, 0)]]])
+        self.assertTrue(p.contains(0, 0.5, 1.5))
+        self.assertTrue(p.contains(0, 1.5, 0.5))
+        self.assertFalse(p.contains(0, 1.5, 1.5))
+
+    def test_precise_lookup(self):
+        import country_bounding_boxes
+        # Give France an outline well away from the test point, and leave
+        # Germany and the Netherlands filling their boxes.
+        rows = [[] for _ in all_country_subunits()]
+        for (i, c) in enumerate(all_country_subunits()):
+            if c.name == 'France':
+                rows[i] = [square(1.0, 47.0, 4.0, 49.0)]
+        saved = dict(country_bounding_boxes._outlines)
+        country_bounding_boxes._outlines['50m'] = polygons_from(rows)
+        try:
+            cs = sorted(c.name for c in by_point(5.983333, 50.883333,
+                                                 precise=True))
+            self.assertEqual(cs, ['Germany', 'Netherlands'])
+            cs = sorted(c.name for c in by_point(2.35, 48.85, precise=True))
+            self.assertEqual(cs, ['France'])
+        finally:
+            country_bounding_boxes._outlines.clear()
+            country_bounding_boxes._outlines.update(saved)
+        self.assertEqual(point_to_names(5.983333, 50.883333),
+                         ['France', 'Germany', 'Netherlands'])
+
+    def test_missing_outlines(self):
+        import country_bounding_boxes
+        from country_bounding_boxes import _polygons, MissingOutlines
+        from country_bounding_boxes.cli import main
+        saved = (dict(country_bounding_boxes._outlines),
+                 _polygons.polygon_file)
+        country_bounding_boxes._outlines.clear()
+        _polygons.polygon_file = lambda level: '/nonexistent/p_%s.dat' % level
+        try:
+            with self.assertRaises(MissingOutlines) as cm:
+                by_point(5.983333, 50.883333, precise=True)
+            self.assertTrue('p_50m.dat' in str(cm.exception))
+            self.assertTrue('parse.py' in str(cm.exception))
+            self.assertRaises(SystemExit, main, ['--precise', '-'])
+        finally:
+            country_bounding_boxes._outlines.update(saved[0])
+            _polygons.polygon_file = saved[1]
+
+    def test_resolutions(self):
+        import country_bounding_boxes
+        rows = [[] for _ in all_country_subunits()]
+        coarse = list(rows)
+        for (i, c) in enumerate(all_country_subunits()):
+            if c.name == 'France':
+                rows[i] = [square(1.0, 47.0, 4.0, 49.0)]
+                coarse[i] = [square(1.0, 47.0, 6.0, 51.0)]
+        saved = dict(country_bounding_boxes._outlines)
+        country_bounding_boxes._outlines['10m'] = polygons_from(rows)
+        country_bounding_boxes._outlines['110m'] = polygons_from(coarse)
+        try:
+            for (level, names) in [('10m', ['Germany', 'Netherlands']),
+                                   ('110m', ['France', 'Germany',
+                                             'Netherlands'])]:
+                cs = sorted(c.name for c in by_point(
+                    5.983333, 50.883333, precise=True, resolution=level))
+                self.assertEqual(cs, names)
+            self.assertRaises(ValueError, by_point, 5.983333, 50.883333,
+                              precise=True, resolution='1m')
+            # Even where no box matches.
+            self.assertRaises(ValueError, by_point, 0.0, 0.0,
+                              precise=True, resolution='1m')
+        finally:
+            country_bounding_boxes._outlines.clear()
+            country_bounding_boxes._outlines.update(saved)
+
+
+def load_parse():
+    # parse.py, from the source checkout, as a module of its own; it needs
+    # iso3166 from requirements/build.txt.
+    import os
+    import types
+    from unittest import SkipTest
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path = os.path.join(root, 'parse.py')
+    if not os.path.exists(path):
+        raise SkipTest("parse.py is not here")
+    try:
+        import iso3166  # noqa: F401
+    except ImportError:
+        raise SkipTest("iso3166 is not installed")
+    mod = types.ModuleType('parse')
+    mod.__file__ = path
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), mod.__dict__)
+    return mod
+
+
+class FakeShape(object):
+
+    def __init__(self, rings):
+        self.points = [p for r in rings for p in r]
+        self.parts = [sum(len(r) for r in rings[:k])
+                      for k in range(len(rings))]
+
+
+class FakeShapefile(object):
+    # Stands in for the pyshp module: Reader serves the given (su_a3,
+    # rings) records, whatever file it is asked for.
+
+    def __init__(self, records):
+        self.records = records
+
+    def Reader(self, fn):
+        records = self.records
+
+        class Reader(object):
+            fields = [('DeletionFlag', 'C', 1, 0), ['NAME', 'C', 40, 0],
+                      ['SU_A3', 'C', 3, 0]]
+
+            def shapes(self):
+                return [FakeShape(rings) for (_, rings) in records]
+
+            def records(self):
+                return [['Name of ' + code, code.encode('latin-1')]
+                        for (code, _) in records]
+
+        return Reader()
+
+
+class TestParse(TestCase):
+
+    def setUp(self):
+        self.parse = load_parse()
+
+    def use_shapefile(self, records):
+        saved = sys.modules.get('shapefile')
+        sys.modules['shapefile'] = FakeShapefile(records)
+        if saved is None:
+            self.addCleanup(sys.modules.pop, 'shapefile')
+        else:
+            self.addCleanup(sys.modules.__setitem__, 'shapefile', saved)
+
+    def test_simplify_run(self):
+        simplify = self.parse._simplify_run
+        line = [(float(x), 0.001 * (x % 2)) for x in range(11)]
+        self.assertEqual(simplify(line, 0.01), [(0.0, 0.0), (10.0, 0.0)])
+        self.assertEqual(simplify(line, 0.0001), line)
+        bent = [(0.0, 0.0), (1.0, 0.0), (2.0, 0.0), (2.0, 1.0), (2.0, 2.0)]
+        self.assertEqual(simplify(bent, 0.01),
+                         [(0.0, 0.0), (2.0, 0.0), (2.0, 2.0)])
+        # A run that comes back to where it started measures from there.
+        loop = [(0.0, 0.0), (1.0, 1.0), (0.0, 0.0)]
+        self.assertEqual(simplify(loop, 0.01), loop)
+
+    def test_simplify_ring(self):
+        simplify = self.parse.simplify_ring
+        steps = [k / 10.0 for k in range(10)]
+        ring = ([(t, 0.0) for t in steps] + [(1.0, t) for t in steps] +
+                [(1.0 - t, 1.0) for t in steps] +
+                [(0.0, 1.0 - t) for t in steps] + [(0.0, 0.0)])
+        self.assertEqual(simplify(ring, 0.01),
+                         [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0),
+                          (0.0, 0.0)])
+        # Simplifying a ring away to a sliver keeps it as it was.
+        for tolerance in [0.5, 10.0]:
+            out = simplify(ring, tolerance)
+            self.assertTrue(len(out) >= 4)
+            self.assertEqual(out[0], out[-1])
+        self.assertEqual(simplify(ring, 10.0), ring)
+        small = [[0, 0], [1, 0], [0, 1], [0, 0]]
+        self.assertEqual(simplify(small, 10.0),
+                         [(0, 0), (1, 0), (0, 1), (0, 0)])
+
+    def test_split_rings(self):
+        east = square(178.0, -18.0, 180.0, -16.0)
+        west = square(-180.0, -18.0, -179.0, -16.0)
+        # Mostly west, with a point on the line itself.
+        edge = [(-180.0, -17.0), (-179.5, -17.0), (-179.5, -16.5),
+                (180.0, -16.5), (-180.0, -17.0)]
+        (lo, hi) = self.parse.split_rings([east, west, edge])
+        self.assertEqual(lo, [west, edge])
+        self.assertEqual(hi, [east])
+
+    def test_extract_outlines_shared_codes(self):
+        # Fiji, Russia and Antarctica are each split at the date line
+        # into two rows of one code, and each has more than one record in
+        # the shapefile.
+        fji_w = square(-180.0, -17.0, -179.8, -16.0)
+        fji_e = [square(177.0, -19.0, 179.0, -17.0),
+                 square(179.5, -17.0, 180.0, -16.0)]
+        rus_w = square(-180.0, 65.0, -169.0, 70.0)
+        rus_e = square(20.0, 41.0, 180.0, 82.0)
+        ata_w = square(-180.0, -90.0, -1.0, -60.0)
+        ata_e = square(0.0, -90.0, 180.0, -60.0)
+        gbr = square(-8.0, 50.0, 2.0, 61.0)
+        self.use_shapefile([
+            ('FJI', [fji_e[0], fji_w]), ('RUS', [rus_e]), ('GBR', [gbr]),
+            ('FJI', [fji_e[1]]), ('ATA', [ata_w, ata_e]),
+            ('RUS', [rus_w])])
+        fields = ['name', 'su_a3']
+        rows = [[(0, 0, 0, 0), 'Fiji', 'FJI'], [(0, 0, 0, 0), 'Fiji', 'FJI'],
+                [(0, 0, 0, 0), 'Russia', 'RUS'],
+                [(0, 0, 0, 0), 'Russia', 'RUS'],
+                [(0, 0, 0, 0), 'England', 'GBR'],
+                [(0, 0, 0, 0), 'Antarctica', 'ATA'],
+                [(0, 0, 0, 0), 'Antarctica', 'ATA']]
+        sides = [0, 1, 0, 1, None, 0, 1]
+        got = self.parse.extract_outlines('10m', fields, rows, sides)
+        self.assertEqual(got, [[fji_w], fji_e, [rus_w], [rus_e], [gbr],
+                               [ata_w], [ata_e]])
+
+    def test_extract_outlines_unmatched(self):
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        fra = square(-5.0, 42.0, 8.0, 51.0)
+        self.use_shapefile([('FRA', [fra]), ('XXX', [square(0, 0, 1, 1)])])
+        fields = ['name', 'su_a3']
+        rows = [[(0, 0, 0, 0), 'France', 'FRA'],
+                [(0, 0, 0, 0), 'Somaliland', 'SOL'],
+                [(0, 0, 0, 0), 'Kosovo', 'KOS'],
+                [(0, 0, 0, 0), 'Somaliland', 'SOL']]
+        saved = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            got = self.parse.extract_outlines('10m', fields, rows,
+                                              [None] * 4)
+            err = sys.stderr.getvalue()
+        finally:
+            sys.stderr = saved
+        self.assertEqual(got, [[fra], [], [], []])
+        self.assertEqual(err, "3 of 4 subunits have no 10m outline: "
+                              "KOS, SOL\n")
@@ -1,42 +1,127 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import shapefile
-import urllib2
+import iso3166
+import json
 import os.path
+import runpy
+import sys
+from collections import namedtuple
 from zipfile import ZipFile
 
-fn = 'ne_50m_admin_0_map_subunits.zip'
-sh_fn = fn.replace(".zip", ".shp")
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
 
-# Yes, this URL is as weird as it looks. They put the protocol and
-# hostname in there twice. Maybe it's a bug and they're going to
-# fix it someday; for the time being it's required to fetch.
+pkg_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'country_bounding_boxes')
+generated_fn = os.path.join(pkg_dir, 'generated.py')
+data_fn = os.path.join(pkg_dir, 'countries.dat')
 
+# The levels of detail of the subunit outlines, each written to
+# polygons_<level>.dat: the scale of the shapefile each is read from, and
+# the Douglas-Peucker tolerance in degrees they are simplified to. There is
+# no 110m map subunits shapefile, so that level is a coarser simplification
+# of the 50m one.
+polygon_levels = {
+    '10m': ('10m', 0.001),
+    '50m': ('50m', 0.01),
+    '110m': ('50m', 0.1),
+}
 
-url = ('http://www.naturalearthdata.com/' +
-       'http//www.naturalearthdata.com/download/50m/cultural/' + fn)
+# Corrections to the naturalearth data, applied as the data is emitted.
+# The file holds a list of patches, each with a "note" and a "match" of
+# field values selecting the records it applies to, plus either or both
+# of:
+#
+#   "set": field values to overwrite in the matching record itself
+#   "add": field values to overwrite in a copy of the matching record,
+#          which is appended as a new subunit after all the others
+#
+# A "bbox" value is given as a [lon1, lat1, lon2, lat2] list.
+patches_fn = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'patches.json')
 
+if sys.version_info > (3, ):
+    text_type = str
+else:
+    text_type = unicode
 
-def download_shapefile():
-    f = urllib2.urlopen(url)
+
+def shapefile_names(scale):
+    # Yes, this URL is as weird as it looks. They put the protocol and
+    # hostname in there twice. Maybe it's a bug and they're going to
+    # fix it someday; for the time being it's required to fetch.
+    fn = 'ne_' + scale + '_admin_0_map_subunits.zip'
+    url = ('http://www.naturalearthdata.com/' +
+           'http//www.naturalearthdata.com/download/' + scale +
+           '/cultural/' + fn)
+    return (fn, fn.replace(".zip", ".shp"), url)
+
+
+# The country data itself comes from the 50m shapefile.
+(fn, sh_fn, url) = shapefile_names('50m')
+
+
+def download_shapefile(scale='50m'):
+    (fn, _, url) = shapefile_names(scale)
+    f = urlopen(url)
     data = f.read()
     with open(fn, "wb") as out:
         out.write(data)
 
 
-def extract_shapefile():
+def extract_shapefile(scale='50m'):
+    (fn, _, _) = shapefile_names(scale)
     with ZipFile(fn) as z:
         z.extractall()
 
 
 def fmt(x):
-    if isinstance(x, str):
-        return '"' + x.decode("latin-1").encode("utf8").strip() + '"'
+    if isinstance(x, text_type):
+        s = '"' + x + '"'
+        return s if str is text_type else s.encode("utf8")
     else:
         return repr(x)
 
 
+def clean(x):
+    if isinstance(x, bytes):
+        return x.decode("latin-1").strip()
+    else:
+        return x
+
+
+def load_patches():
+    with open(patches_fn) as f:
+        return json.load(f)
+
+
+def _override(names, row, values):
+    row = list(row)
+    for (k, v) in values.items():
+        row[names.index(k)] = tuple(v) if k == 'bbox' else v
+    return row
+
+
+def apply_patches(patches, fields, row):
+    """
+    Apply the patches matching row (a list of bbox and field values).
+    Returns the row, as adjusted by any "set", and the list of new rows
+    derived from it by any "add".
+    """
+    names = ['bbox'] + list(fields)
+    added = []
+    for p in patches:
+        if all(row[names.index(k)] == v for (k, v) in p['match'].items()):
+            if 'set' in p:
+                row = _override(names, row, p['set'])
+            if 'add' in p:
+                added.append(_override(names, row, p['add']))
+    return (row, added)
+
+
 def emit_country(bbox, fields, rec):
     box = str.format("({}, {}, {}, {})", *bbox)
     fs = ','.join([str.format('\n        {}={}', k, fmt(v))
@@ -45,7 +130,191 @@ def emit_country(bbox, fields, rec):
     print('        bbox=' + box + ',' + fs + '),')
 
 
+# The legitimate ISO 3166 alpha2 and alpha3 names, which appear in a variety
+# of contexts in the naturalearth dataset depending on the subunit being
+# described.
+_iso_2_names = set()
+_iso_3_names = set()
+
+
+def _is_iso_3_name(n):
+    if len(_iso_3_names) == 0:
+        for c in iso3166.countries:
+            _iso_3_names.add(c.alpha3)
+    return n in _iso_3_names
+
+
+def _is_iso_2_name(n):
+    if len(_iso_2_names) == 0:
+        for c in iso3166.countries:
+            _iso_2_names.add(c.alpha2)
+    return n in _iso_2_names
+
+
+# Depending on the type of the (sub)unit, the ISO alpha3 name this
+# "country" is connected to might be denoted in a variety of fields. Search
+# them all in a hopefully-useful order of precedence and take the first
+# that looks legit.
+def _best_guess_iso_3(c):
+    for n in [c.iso_a3, c.adm0_a3, c.adm0_a3_is,
+              c.adm0_a3_us, c.gu_a3, c.su_a3, c.sov_a3]:
+        if n != "-99" and _is_iso_3_name(n):
+            return n
+    return None
+
+
+# ISO alpha3 names are much more prevalent in the NE dataset; look up the
+# corresponding alpha2 name from iso3166 and cross-check against any alpha2
+# name we have in the NE record.
+def _best_guess_iso_2(c):
+    iso3 = _best_guess_iso_3(c)
+    if iso3 is None:
+        return None
+    isoc = iso3166.countries.get(iso3)
+    if isoc is None:
+        return None
+    iso2 = isoc.alpha2
+    if c.iso_a2 != "-99" and _is_iso_2_name(c.iso_a2):
+        assert c.iso_a2 == iso2
+    return iso2
+
+
+def iso_index(fields, rows, guess):
+    # Pairs of (code, row) filing each row under its best-guess ISO code.
+    # The package used to collect these into sets, so a row identical to
+    # one already filed under the same code is left out.
+    Country = namedtuple('Country', ['bbox'] + list(fields))
+    seen = {}
+    index = []
+    for (i, row) in enumerate(rows):
+        code = guess(Country(*row))
+        if tuple(row) not in seen.setdefault(code, set()):
+            seen[code].add(tuple(row))
+            index.append((code, i))
+    return index
+
+
+def write_data_file(fields, rows):
+    # The package's own module knows the format; run it by path so that
+    # we do not import the package (which needs this very file).
+    data = runpy.run_path(os.path.join(pkg_dir, '_data.py'))
+    index = runpy.run_path(os.path.join(pkg_dir, 'index.py'))
+    # The spatial indexes are built here once, rather than on every
+    # import; rasterizing the boxes into the point lookup table in
+    # particular takes a while.
+    bboxes = [row[0] for row in rows]
+    data['write'](data_fn, fields, rows,
+                  iso_index(fields, rows, _best_guess_iso_2),
+                  iso_index(fields, rows, _best_guess_iso_3),
+                  index['QuadkeyIndex'].build(bboxes),
+                  index['STRTree'](bboxes))
+
+
+def rebuild_data_file():
+    # Regenerate the data file from the checked-in generated.py, for when
+    # the shapefile is not at hand.
+    g = runpy.run_path(generated_fn)
+    write_data_file(g['Country']._fields[1:], g['countries'])
+
+
+def write_polygon_file(level, outlines):
+    # outlines holds the unsimplified rings of each row.
+    tolerance = polygon_levels[level][1]
+    polygons = runpy.run_path(os.path.join(pkg_dir, '_polygons.py'))
+    polygons['write'](polygons['polygon_file'](level),
+                      [[simplify_ring(r, tolerance) for r in rings]
+                       for rings in outlines])
+
+
+def _simplify_run(points, tolerance):
+    # Douglas-Peucker over an open run of points, keeping both ends.
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        (a, b) = stack.pop()
+        ((ax, ay), (bx, by)) = (points[a], points[b])
+        (dx, dy) = (bx - ax, by - ay)
+        norm = (dx * dx + dy * dy) ** 0.5
+        (far, far_d) = (None, tolerance)
+        for i in range(a + 1, b):
+            (px, py) = points[i]
+            if norm == 0:
+                d = ((px - ax) ** 2 + (py - ay) ** 2) ** 0.5
+            else:
+                d = abs(dy * px - dx * py + bx * ay - by * ax) / norm
+            if d > far_d:
+                (far, far_d) = (i, d)
+        if far is not None:
+            keep[far] = True
+            stack.append((a, far))
+            stack.append((far, b))
+    return [p for (p, k) in zip(points, keep) if k]
+
+
+def simplify_ring(ring, tolerance):
+    # Split the closed ring at its point furthest from the start, so that
+    # both halves are open runs, and keep the original if simplifying
+    # would leave fewer than a triangle.
+    ring = [tuple(p) for p in ring]
+    if len(ring) < 5:
+        return ring
+    (x0, y0) = ring[0]
+    mid = max(range(len(ring)),
+              key=lambda i: (ring[i][0] - x0) ** 2 + (ring[i][1] - y0) ** 2)
+    out = (_simplify_run(ring[:mid + 1], tolerance)[:-1] +
+           _simplify_run(ring[mid:], tolerance))
+    return out if len(out) >= 4 else ring
+
+
+def shape_rings(shape):
+    parts = list(shape.parts) + [len(shape.points)]
+    return [shape.points[parts[k]:parts[k + 1]]
+            for k in range(len(parts) - 1)]
+
+
+def split_rings(rings):
+    # For a shape split at the date line: the rings themselves stop at the
+    # line, so each goes with whichever piece holds most of its points.
+    lo = [r for r in rings if 2 * len([p for p in r if p[0] < 0]) > len(r)]
+    hi = [r for r in rings if r not in lo]
+    return (lo, hi)
+
+
+def extract_outlines(scale, fields, rows, sides):
+    # The outlines of the given rows (from the 50m shapefile) as found in
+    # another scale's shapefile, matched up by subunit code. Rows split at
+    # the date line have a side of 0 (west) or 1 (east), others None.
+    import shapefile
+
+    sf = shapefile.Reader(shapefile_names(scale)[1])
+    names = [f[0].lower() for f in sf.fields if isinstance(f, list)]
+    k = names.index('su_a3')
+    by_code = {}
+    for (shape, rec) in zip(sf.shapes(), sf.records()):
+        by_code.setdefault(clean(rec[k]), []).extend(shape_rings(shape))
+
+    # A row whose code is not in this shapefile is left without an
+    # outline (so precise lookups take it to fill its box); say which, so
+    # that a change of codes between scales does not go unnoticed.
+    j = list(fields).index('su_a3') + 1
+    outlines = []
+    missing = []
+    for (row, side) in zip(rows, sides):
+        rings = by_code.get(row[j], [])
+        if not rings:
+            missing.append(row[j])
+        outlines.append(rings if side is None else split_rings(rings)[side])
+    if missing:
+        sys.stderr.write("%d of %d subunits have no %s outline: %s\n"
+                         % (len(missing), len(rows), scale,
+                            ', '.join(sorted(set(missing)))))
+    return outlines
+
+
 def extract_data():
+    import shapefile
+
     sf = shapefile.Reader(sh_fn)
     fields = [f[0] for f in sf.fields if isinstance(f, list)]
 
@@ -66,6 +335,24 @@ def extract_data():
 
     assert len(shapes) == len(records)
 
+    patches = load_patches()
+    rows = []
+    added = []
+    outlines = []
+    sides = []
+
+    def emit(bbox, rec, rings, side=None):
+        # Round-trip the bbox through the same text generated.py gets, so
+        # both outputs hold identical values.
+        box = tuple(float(str(x)) for x in bbox)
+        (row, new) = apply_patches(patches, fields,
+                                   [box] + [clean(v) for v in rec])
+        emit_country(row[0], fields, row[1:])
+        rows.append(row)
+        outlines.append(rings)
+        sides.append(side)
+        added.extend(new)
+
     print("countries = [")
     for i in range(0, len(records)):
         rec = records[i]
@@ -76,7 +363,7 @@ def extract_data():
             # the Netherlands; it includes the extent of the Caribbean
             # Netherlands by accident. Correct that here.
             bbox = [3.133, 50.750, 7.217, 53.683]
-            emit_country(bbox, fields, rec)
+            emit(bbox, rec, shape_rings(shapes[i]))
 
         elif abs(shapes[i].bbox[0] - shapes[i].bbox[2]) > 340:
 
@@ -115,17 +402,38 @@ def extract_data():
             print(str.format('    # [{}, {}, {}, {}]', *lo_box))
             print(str.format('    # [{}, {}, {}, {}]', *hi_box))
 
-            emit_country(lo_box, fields, rec)
-            emit_country(hi_box, fields, rec)
+            (lo_rings, hi_rings) = split_rings(shape_rings(shapes[i]))
+            emit(lo_box, rec, lo_rings, 0)
+            emit(hi_box, rec, hi_rings, 1)
 
         else:
-            emit_country(shapes[i].bbox, fields, rec)
+            emit(shapes[i].bbox, rec, shape_rings(shapes[i]))
 
+    print('    # Subunits added by ' + os.path.basename(patches_fn))
+    for row in added:
+        emit_country(row[0], fields, row[1:])
     print(']')
 
+    write_data_file(fields, rows + added)
+
+    # Subunits added by patches have no outline of their own.
+    none = [[] for _ in added]
+    for (level, (scale, _)) in sorted(polygon_levels.items()):
+        if scale != '50m':
+            outlines_at = extract_outlines(scale, fields, rows, sides)
+        else:
+            outlines_at = outlines
+        write_polygon_file(level, outlines_at + none)
+
+
 if __name__ == "__main__":
-    if not os.path.exists(fn):
-        download_shapefile()
-    if not os.path.exists(sh_fn):
-        extract_shapefile()
+    if "--data-only" in sys.argv[1:]:
+        rebuild_data_file()
+        sys.exit(0)
+    for scale in sorted(set(s for (s, _) in polygon_levels.values())):
+        (zip_fn, shp_fn, _) = shapefile_names(scale)
+        if not os.path.exists(zip_fn):
+            download_shapefile(scale)
+        if not os.path.exists(shp_fn):
+            extract_shapefile(scale)
     extract_data()
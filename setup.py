@@ -11,7 +11,9 @@ setup(
     url='https://github.com/graydon/country-bounding-boxes',
     include_package_data=True,
     packages=['country_bounding_boxes'],
-    install_requires=['iso3166'],
+    package_data={'country_bounding_boxes': ['*.dat']},
+    install_requires=[],
+    extras_require={'numpy': ['numpy']},
     classifiers=[
         'Intended Audience :: Developers',
         'Natural Language :: English',